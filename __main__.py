@@ -1,11 +1,13 @@
 from datetime import datetime
 
 from geni_family_tree import GeniFamilyTreeGenerator
+from response_cache import ResponseCache
 
 start = datetime.now()
 
-generator = GeniFamilyTreeGenerator()
-family_tree = generator.generate_tree(max_depth=10)
+with GeniFamilyTreeGenerator(max_in_flight=8, cache=ResponseCache('geni-cache.sqlite'),
+                             checkpoint_path='crawl-checkpoint.jsonl') as generator:
+    family_tree = generator.generate_tree(max_depth=10, resume=True)
 # family_tree.print_tree()
 print('\nFamily names:\n', '\n '.join(family_tree.family_names()))
 
@@ -0,0 +1,250 @@
+import filecmp
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from anytree import Node
+
+import gedcom_cleaner
+import geni_add_profiles_file
+from family_tree import FamilyTree, PersonData
+from gedcom_family_tree import GedcomFamilyTreeGenerator
+from geni_add_profiles_file import DATA_EXTRACTORS, DATA_UPDATERS, extract_profiles
+from geni_api import new_session
+
+
+class StubGeniHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    wbufsize = -1  # send headers and body in one write
+
+    def do_GET(self):
+        body = b'{"id": "profile-1", "first_name": "Stub", "last_name": "Profile"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGeniHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/api/'
+
+
+def time_per_request(get, url, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        get(url).json()
+    return (time.perf_counter() - start) / n
+
+
+def bench_session(n=500):
+    server, base_url = start_stub_server()
+    url = base_url + 'profile'
+    try:
+        unpooled = time_per_request(requests.get, url, n)
+        pooled = time_per_request(new_session().get, url, n)
+    finally:
+        server.shutdown()
+    print(f'requests.get:   {unpooled * 1000:.3f} ms/request')
+    print(f'pooled session: {pooled * 1000:.3f} ms/request ({unpooled / pooled:.1f}x)')
+
+
+def synthetic_people(n):
+    """A pedigree where person i has parents 2i + 1 and 2i + 2, with names repeating as in real trees."""
+    for i in range(n):
+        first, last = f'First{i % 500}', f'Last{i % 2000}'
+        yield PersonData(id=f'profile-{i}', first_name=first, last_name=last, display_name=f'{first} {last}',
+                         updated_at=f'2020-01-{i % 28 + 1:02}')
+
+
+def traced(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def bench_family_tree_memory(n=200000):
+    def node_layout():
+        # FamilyTree before it was columnar: an anytree Node per person, wrapped in a Person namedtuple.
+        node_person = namedtuple('Person', ('data', 'ancestors', 'descendants'))
+        nodes = []
+        for i, data in enumerate(synthetic_people(n)):
+            nodes.append(Node(name=data.id, parent=nodes[(i - 1) // 2] if i else None, data=data))
+        return {node.name: node_person(data=node.data, ancestors=node, descendants=None) for node in nodes}
+
+    def compact_layout():
+        tree = FamilyTree(root='profile-0', people=synthetic_people(n))
+        for i in range(1, n):
+            tree.add_parent(tree.ids[(i - 1) // 2], tree.ids[i])
+        tree.parents('profile-0')  # build the adjacency arrays
+        return tree
+
+    for name, build in [('anytree nodes', node_layout), ('FamilyTree', compact_layout)]:
+        _, size, elapsed = traced(build)
+        print(f'{name:14} {size / n:7.1f} bytes/person, built in {elapsed:.2f}s')
+
+
+def bench_family_tree_load(n=1000000):
+    tree = FamilyTree(root='profile-0', people=synthetic_people(n))
+    for i in range(1, n):
+        tree.add_parent(tree.ids[(i - 1) // 2], tree.ids[i])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.bin')
+        start = time.perf_counter()
+        tree.save(path)
+        print(f'saved {n} people ({os.path.getsize(path) / 2 ** 20:.1f} MiB) in {time.perf_counter() - start:.2f}s')
+        del tree
+
+        loaded, size, elapsed = traced(lambda: FamilyTree.load(path))
+        print(f'loaded in {elapsed * 1000:.2f}ms, {size / 2 ** 10:.1f} KiB allocated')
+        start = time.perf_counter()
+        for i in range(0, n, n // 1000):
+            loaded.parents(f'profile-{i}')
+        print(f'id lookup + parents: {(time.perf_counter() - start) * 1000:.3f}ms per 1000')
+        del loaded
+
+
+def bench_gedcom_import(n=1000000):
+    tree = FamilyTree(root='profile-0', people=synthetic_people(n))
+    for i in range(1, n):
+        tree.add_parent(tree.ids[(i - 1) // 2], tree.ids[i])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.ged')
+        tree.export_gedcom(path)
+        del tree
+        start = time.perf_counter()
+        imported = GedcomFamilyTreeGenerator(path, use_refn=True).generate_tree(root_id='profile-0')
+        elapsed = time.perf_counter() - start
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f'imported {len(imported)} people ({os.path.getsize(path) / 2 ** 20:.0f} MiB) in {elapsed:.1f}s, '
+              f'max RSS {max_rss / 1024:.0f} MiB')
+        assert sorted(imported.parents('profile-0')) == ['profile-1', 'profile-2']
+
+
+SYNTHETIC_INDI = '''0 @I{i}@ INDI
+1 NAME Jozsef{i} /Weiszhausz/
+1 SEX M
+1 BIRT
+2 DATE 01 MAR 1894
+2 ADDR Kossuth utca {i}
+3 CONT Nyiregyhaza
+2 CITY Nyiregyhaza
+2 STAE Szabolcs
+2 CTRY Hungary
+1 DEAT
+2 DATE 1944
+2 PLAC Auschwitz
+1 NOTE Father's birthplace: Balkany, Szabolcs/Mother's birthplace: Nyiregyhaza, LDS 642913, a note long enough to
+2 CONC  need a continuation line
+1 FAMC @F{i}@
+'''
+SYNTHETIC_FAM = '''0 @F{i}@ FAM
+1 HUSB @I{i}@
+1 MARR
+2 DATE 1920
+2 PLAC Debrecen
+1 CHIL @I{i}@
+'''
+
+
+def write_synthetic_gedcom(path, size):
+    with open(path, 'w') as f:
+        f.write('0 HEAD\n1 GEDC\n2 VERS 5.5.1\n1 CHAR UTF-8\n')
+        i = 0
+        while f.tell() < size:
+            f.write(''.join(SYNTHETIC_INDI.format(i=j) + SYNTHETIC_FAM.format(i=j) for j in range(i, i + 1000)))
+            i += 1000
+        f.write('0 TRLR\n')
+
+
+def bench_gedcom_clean(size=2 ** 30, processes=(1, None)):
+    with tempfile.TemporaryDirectory() as directory:
+        inpath = os.path.join(directory, 'in.ged')
+        write_synthetic_gedcom(inpath, size)
+        size = os.path.getsize(inpath)
+        outputs = []
+        for n in processes:
+            outpath = os.path.join(directory, f'out-{n}.ged')
+            start = time.perf_counter()
+            gedcom_cleaner.process_gedcom(inpath, outpath, processes=n)
+            elapsed = time.perf_counter() - start
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            print(f'processes={n or os.cpu_count()}: {size / 2 ** 20:.0f} MiB in {elapsed:.1f}s: '
+                  f'{size / 2 ** 20 / elapsed:.1f} MiB/s, max RSS {max_rss / 1024:.0f} MiB')
+            outputs.append(outpath)
+        for outpath in outputs[1:]:
+            assert filecmp.cmp(outputs[0], outpath, shallow=False), outpath
+
+
+def synthetic_records(n):
+    """Transcribed register rows like those in profile.geni, with towns, dates and names repeating."""
+    towns = ['Debrecen', 'Nyiregyhaza', 'Nyírbátor', 'Kisvárda', 'Szeged', 'Tiszafüred']
+    for i in range(n):
+        record = {'about_me': f'ROSENFELD, Jeno {i} LDS 642807, Vol. 2', 'first_name': f'jeno{i % 300} ',
+                  'birth_date': f'{i % 28 + 1}-{MONTH_NAMES[i % 12]}-{1850 + i % 60}', 'gender': 'mf'[i % 2],
+                  'birth_town': towns[i % len(towns)]}
+        if i % 3 == 0:
+            record['name'] = f'WEISZHAUSZ{i % 50}, Jozsef'
+        if i % 5 == 0:
+            record['death_date'] = f'{i % 28 + 1}-{MONTH_NAMES[i % 12]}-{1900 + i % 44}'
+        yield record
+
+
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def bench_profile_extract(n=50000):
+    def per_record(records):
+        # ProfileAdder.get_update before extract_profiles: every extractor and updater for every record.
+        profiles = []
+        for file_profile in records:
+            profile = {}
+            for key, extractor in DATA_EXTRACTORS:
+                profile.update(extractor(file_profile) or {})
+            for updater in DATA_UPDATERS:
+                for key, value in profile.items():
+                    profile[key] = updater(key, value)
+            profiles.append(profile)
+        return profiles
+
+    records = list(synthetic_records(n))
+    outputs = []
+    for name, extract in [('per record', per_record), ('batch', extract_profiles)]:
+        for cache in ['split_name', 'event_date', 'event_location', 'compiled_extractors']:
+            getattr(geni_add_profiles_file, cache).cache_clear()
+        start = time.perf_counter()
+        outputs.append(extract(records))
+        elapsed = time.perf_counter() - start
+        print(f'{name:10} {n} records in {elapsed:.2f}s: {n / elapsed:,.0f} records/s')
+    assert outputs[0] == outputs[1]
+
+
+BENCHMARKS = {
+    'session': bench_session,
+    'family_tree_memory': bench_family_tree_memory,
+    'family_tree_load': bench_family_tree_load,
+    'gedcom_clean': bench_gedcom_clean,
+    'gedcom_import': bench_gedcom_import,
+    'profile_extract': bench_profile_extract,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        print(f'== {name}')
+        BENCHMARKS[name]()
@@ -0,0 +1,111 @@
+import json
+import os
+from collections import namedtuple
+from queue import Queue
+from typing import Optional
+
+from anytree import Node
+
+from family_tree import PersonData
+
+ANCESTORS = 'ancestors'
+DESCENDANTS = 'descendants'
+
+CrawlState = namedtuple('CrawlState', ['root', 'queues', 'processed', 'queued_keys'])
+
+
+class JournaledQueue(Queue):
+    def __init__(self, name, checkpoint):
+        super().__init__()
+        self.name = name
+        self.checkpoint = checkpoint
+
+    def put(self, item, block=True, timeout=None):
+        self.checkpoint.enqueued(self.name, item)
+        super().put(item, block, timeout)
+
+
+class CrawlCheckpoint:
+    """
+    Append-only journal of a crawl: every node put on a queue, and every node whose family has been enqueued.
+    Replaying it rebuilds the node trees, the pending queues and the processed maps of an interrupted crawl.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.keys = {}
+
+    def _write(self, event):
+        self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+
+    def start(self, root_id, max_depth):
+        self.keys = {}
+        self.file = open(self.path, 'w')
+        self._write({'event': 'start', 'root': root_id, 'max_depth': max_depth})
+
+    def resume(self, root_id, max_depth) -> Optional[CrawlState]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            events = []
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # partially written last line
+        if not events or events[0] != {'event': 'start', 'root': root_id, 'max_depth': max_depth}:
+            print('Checkpoint', self.path, 'is for a different crawl, starting over')
+            return None
+
+        self.keys = {}
+        self.file = open(self.path, 'a')
+        nodes = {}
+        enqueued = {}
+        done = {}
+        for event in events[1:]:
+            if event['event'] == 'enqueued':
+                parent = nodes[event['parent']] if event['parent'] is not None else None
+                node = Node(name=event['id'], parent=parent, data=PersonData(*event['data']), direction=event['queue'])
+                nodes[event['key']] = node
+                self.keys[id(node)] = event['key']
+                enqueued.setdefault(event['queue'], []).append(event['key'])
+            elif event['event'] == 'processed':
+                done.setdefault(event['queue'], []).append(event['key'])
+
+        queues = {}
+        processed = {}
+        for name in [ANCESTORS, DESCENDANTS]:
+            name_done = set(done.get(name, []))
+            queues[name] = self.queue(name)
+            for key in enqueued.get(name, []):
+                if key not in name_done:
+                    Queue.put(queues[name], nodes[key])  # already journaled
+            processed[name] = {nodes[key].name: nodes[key] for key in done.get(name, [])}
+        queued_keys = {name: {nodes[key].name for key in keys} for name, keys in enqueued.items()}
+        print('Resuming crawl from', self.path, 'with', sum(q.qsize() for q in queues.values()), 'queued profiles')
+        return CrawlState(root=nodes[enqueued[ANCESTORS][0]], queues=queues, processed=processed,
+                          queued_keys=queued_keys)
+
+    def queue(self, name) -> Queue:
+        return JournaledQueue(name, self)
+
+    def enqueued(self, queue_name, node):
+        if not self.file:
+            return
+        key = len(self.keys)
+        self.keys[id(node)] = key
+        parent = self.keys[id(node.parent)] if node.parent else None
+        self._write({'event': 'enqueued', 'key': key, 'queue': queue_name, 'id': node.name, 'parent': parent,
+                     'data': list(node.data)})
+
+    def processed(self, queue_name, node):
+        if not self.file:
+            return
+        self._write({'event': 'processed', 'key': self.keys[id(node)], 'queue': queue_name})
+
+    def finish(self):
+        self.file.close()
+        self.file = None
+        os.remove(self.path)
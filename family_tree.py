@@ -1,19 +1,499 @@
-from collections import namedtuple
+import json
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import namedtuple, deque
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, List, Set, Tuple
 
-from anytree import RenderTree
+Person = namedtuple('Person', ('data', 'parents', 'children'))
+PersonData = namedtuple('PersonData', ('id', 'first_name', 'last_name', 'display_name', 'updated_at', 'details'),
+                        defaults=(None, None))
 
-Person = namedtuple('Person', ('data', 'ancestors', 'descendants'))
-PersonData = namedtuple('PersonData', ('id', 'first_name', 'last_name', 'display_name'))
+NAME_COLUMNS = ('first_name', 'last_name', 'display_name', 'updated_at')
+
+MIN_PENDING_EDGES = 1024
+
+MAGIC = b'FAMTREE1'
+# magic, byte order, root, people, strings, string bytes, edges, last names, details bytes
+HEADER = struct.Struct('<8s4sIIIIIII')
+BYTE_ORDER = sys.byteorder[:4].encode().ljust(4, b'\0')
+
+
+class StringTable:
+    """Interns strings to integers; index 0 is None."""
+
+    def __init__(self):
+        self.strings = [None]
+        self.index = {None: 0}
+
+    def intern(self, string) -> int:
+        i = self.index.get(string)
+        if i is None:
+            i = self.index[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def __len__(self):
+        return len(self.strings)
+
+    def lookup(self, string):
+        return self.index.get(string)
+
+
+class MappedStrings:
+    """Read-only string table over a saved file, decoding strings on access."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self._index = None
+
+    def __getitem__(self, i):
+        if i == 0:
+            return None
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lookup(self, string):
+        if self._index is None:
+            self._index = {self[i]: i for i in range(len(self))}
+        return self._index.get(string)
+
+
+class MappedIds(Sequence):
+    def __init__(self, strings, id_strings):
+        self.strings = strings
+        self.id_strings = id_strings
+
+    def __getitem__(self, i):
+        return self.strings[self.id_strings[i]]
+
+    def __len__(self):
+        return len(self.id_strings)
+
+
+class MappedIndex(Mapping):
+    """Id to person index, by binary search over the ids in sorted order, so that loading builds no dict."""
+
+    def __init__(self, ids, sorted_people):
+        self.ids = ids
+        self.sorted_people = sorted_people
+
+    def __getitem__(self, person_id):
+        lo, hi = 0, len(self.sorted_people)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ids[self.sorted_people[mid]] < person_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.sorted_people) and self.ids[self.sorted_people[lo]] == person_id:
+            return self.sorted_people[lo]
+        raise KeyError(person_id)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class MappedGroups(Mapping):
+    """Last name string index to the people with that last name, as CSR arrays sorted by string index."""
+
+    def __init__(self, keys, offsets, indices):
+        self.keys = keys
+        self.offsets = offsets
+        self.indices = indices
+
+    def __getitem__(self, key):
+        k = bisect_left(self.keys, key)
+        if k == len(self.keys) or self.keys[k] != key:
+            raise KeyError(key)
+        return self.indices[self.offsets[k]:self.offsets[k + 1]]
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def build_csr(size, pairs):
+    """Compressed sparse rows for (row, column) pairs sorted by row: row r's columns are indices[offsets[r]:offsets[r+1]]."""
+    offsets = array('I', [0] * (size + 1))
+    for row, _ in pairs:
+        offsets[row + 1] += 1
+    for row in range(size):
+        offsets[row + 1] += offsets[row]
+    return offsets, array('I', (column for _, column in pairs))
+
+
+class PeopleView(Mapping):
+    def __init__(self, family_tree):
+        self.family_tree = family_tree
+
+    def __getitem__(self, person_id) -> Person:
+        tree = self.family_tree
+        return Person(data=tree.data(person_id), parents=tree.parents(person_id), children=tree.children(person_id))
+
+    def __iter__(self):
+        return iter(self.family_tree)
+
+    def __len__(self):
+        return len(self.family_tree)
 
 
 class FamilyTree:
-    def __init__(self, root, people=None):
+    """
+    People are interned to consecutive integers. Name fields are stored column-wise as string table indices, and
+    parent/child edges as CSR adjacency arrays. Edges added or removed since the arrays were built are kept aside and
+    merged into the answers for the people they touch; the arrays are only rebuilt once there are many of them.
+    """
+
+    def __init__(self, root, people: Iterable[PersonData] = None):
         self.root = root
-        self.people = {} if not people else people
+        self.mapped = None
+        self.strings = StringTable()
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.columns = {column: array('I') for column in NAME_COLUMNS}
+        self.details: Dict[int, dict] = {}
+        self.by_last_name: Dict[int, array] = {}
+        self.edge_parents = array('I')
+        self.edge_children = array('I')
+        self.csr = None
+        self.pending_edges: Dict[Tuple[int, int], bool] = {}  # (parent, child): added or removed since the CSR
+        self.pending_parents: Dict[int, Set[int]] = {}  # child: parents with a pending edge
+        self.pending_children: Dict[int, Set[int]] = {}  # parent: children with a pending edge
+        for data in people or []:
+            self.add_person(data)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, person_id):
+        return person_id in self.index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    @property
+    def people(self) -> Mapping:
+        return PeopleView(self)
+
+    def _thaw(self):
+        """Copies a memory-mapped tree into mutable structures before its first change."""
+        if self.mapped is None:
+            return
+        strings = StringTable()
+        strings.strings = [self.strings[i] for i in range(len(self.strings))]
+        strings.index = {string: i for i, string in enumerate(strings.strings)}
+        self.strings = strings
+        self.ids = list(self.ids)
+        self.index = {person_id: i for i, person_id in enumerate(self.ids)}
+        self.columns = {column: array('I', values) for column, values in self.columns.items()}
+        self.by_last_name = {key: array('I', people) for key, people in self.by_last_name.items()}
+        self.edge_parents = array('I', self.edge_parents)
+        self.edge_children = array('I', self.edge_children)
+        self.csr = None
+        self.mapped = None  # unmapped once the views on it are gone
+
+    def add_person(self, data: PersonData) -> int:
+        if data.id in self.index:
+            return self.index[data.id]
+        self._thaw()
+        i = self.index[data.id] = len(self.ids)
+        self.ids.append(data.id)
+        for column in NAME_COLUMNS:
+            self.columns[column].append(self.strings.intern(getattr(data, column)))
+        if data.details is not None:
+            self.details[i] = data.details
+        self.by_last_name.setdefault(self.columns['last_name'][i], array('I')).append(i)
+        return i
+
+    def update_data(self, person_id, data: PersonData):
+        self._thaw()
+        i = self.index[person_id]
+        old_last_name = self.columns['last_name'][i]
+        for column in NAME_COLUMNS:
+            self.columns[column][i] = self.strings.intern(getattr(data, column))
+        if data.details is not None:
+            self.details[i] = data.details
+        if self.columns['last_name'][i] != old_last_name:
+            self.by_last_name[old_last_name].remove(i)
+            if not self.by_last_name[old_last_name]:
+                del self.by_last_name[old_last_name]
+            self.by_last_name.setdefault(self.columns['last_name'][i], array('I')).append(i)
+
+    def data(self, person_id) -> PersonData:
+        i = self.index[person_id]
+        strings = self.strings
+        return PersonData(self.ids[i], *[strings[self.columns[column][i]] for column in NAME_COLUMNS],
+                          details=self.details.get(i))
+
+    def _pend(self, parent, child, present):
+        self._thaw()
+        self.pending_edges[(parent, child)] = present
+        self.pending_parents.setdefault(child, set()).add(parent)
+        self.pending_children.setdefault(parent, set()).add(child)
+
+    def add_parent(self, child_id, parent_id):
+        self._pend(self.index[parent_id], self.index[child_id], True)
+
+    def remove_parent(self, child_id, parent_id):
+        self._pend(self.index[parent_id], self.index[child_id], False)
+
+    def _adjacency(self, merge=False):
+        """:param merge: rebuild with the pending edges even if there are few of them, for code reading the arrays"""
+        pending = len(self.pending_edges)
+        if self.csr is None or (pending and merge) or pending > max(MIN_PENDING_EDGES, len(self.edge_parents) // 8):
+            edges = set(zip(self.edge_parents, self.edge_children))
+            for edge, present in self.pending_edges.items():
+                if present:
+                    edges.add(edge)
+                else:
+                    edges.discard(edge)
+            edges = sorted(edges)
+            self.pending_edges, self.pending_parents, self.pending_children = {}, {}, {}
+            self.edge_parents = array('I', (p for p, _ in edges))
+            self.edge_children = array('I', (c for _, c in edges))
+            size = len(self.ids)
+            self.csr = {
+                'children': build_csr(size, edges),
+                'parents': build_csr(size, sorted((c, p) for p, c in edges)),
+            }
+        return self.csr
+
+    def _related(self, direction, i, edge):
+        offsets, indices = self._adjacency()[direction]
+        related = indices[offsets[i]:offsets[i + 1]] if i + 1 < len(offsets) else ()  # people added since
+        changed = (self.pending_parents if direction == 'parents' else self.pending_children).get(i)
+        if not changed:
+            return related
+        return sorted({j for j in related if j not in changed} | {j for j in changed if self.pending_edges[edge(j)]})
+
+    def parent_indices(self, i):
+        return self._related('parents', i, lambda p: (p, i))
+
+    def child_indices(self, i):
+        return self._related('children', i, lambda c: (i, c))
+
+    def parents(self, person_id) -> List[str]:
+        return [self.ids[p] for p in self.parent_indices(self.index[person_id])]
+
+    def children(self, person_id) -> List[str]:
+        return [self.ids[c] for c in self.child_indices(self.index[person_id])]
+
+    def with_last_name(self, last_name) -> List[str]:
+        i = self.strings.lookup(last_name)
+        return [self.ids[p] for p in self.by_last_name.get(i, [])] if i else []
+
+    def generations(self) -> Dict[str, int]:
+        """Number of generations between the root and each of its ancestors, by shortest line."""
+        root = self.index[self.root]
+        depths = {root: 0}
+        queue = deque([root])
+        while queue:
+            i = queue.popleft()
+            for p in self.parent_indices(i):
+                if p not in depths:
+                    depths[p] = depths[i] + 1
+                    queue.append(p)
+        return {self.ids[i]: depth for i, depth in depths.items()}
+
+    def remove_unreachable(self):
+        """Drops people no longer connected to the root by any chain of parent and child edges."""
+        reachable = {self.index[self.root]}
+        queue = deque(reachable)
+        while queue:
+            i = queue.popleft()
+            for j in list(self.parent_indices(i)) + list(self.child_indices(i)):
+                if j not in reachable:
+                    reachable.add(j)
+                    queue.append(j)
+        if len(reachable) == len(self.ids):
+            return
+        compacted = FamilyTree(self.root, [self.data(self.ids[i]) for i in sorted(reachable)])
+        self._adjacency(merge=True)
+        for p, c in zip(self.edge_parents, self.edge_children):
+            if p in reachable and c in reachable:
+                compacted.add_parent(self.ids[c], self.ids[p])
+        self.__dict__.update(compacted.__dict__)
 
     def print_tree(self):
-        for pre, fill, node in RenderTree(self.people[self.root].ancestors):
-            print("%s%s" % (pre, self.people[node.name].data.display_name))
+        def render(i, pre, fill):
+            print("%s%s" % (pre, self.strings[self.columns['display_name'][i]]))
+            parents = self.parent_indices(i)
+            for n, p in enumerate(parents):
+                last = n == len(parents) - 1
+                render(p, fill + ('└── ' if last else '├── '), fill + ('    ' if last else '│   '))
+
+        render(self.index[self.root], '', '')
 
     def family_names(self):
-        return sorted({v.data.last_name for v in self.people.values()})
+        return sorted(self.strings[i] for i in self.by_last_name)
+
+    def save(self, path):
+        """
+        Binary format: a header, then native-order uint32 arrays (string offsets, ids, name columns, edges sorted by
+        parent, CSR adjacency in both directions, people sorted by id, last name groups), the utf-8 string blob and
+        the details as JSON.
+        """
+        children_offsets, children = self._adjacency(merge=True)['children']
+        parents_offsets, parents = self.csr['parents']
+        strings = StringTable()
+        for i in range(1, len(self.strings)):
+            strings.intern(self.strings[i])  # keeps the indices used by the columns
+        id_strings = array('I', (strings.intern(person_id) for person_id in self.ids))
+        root = strings.intern(self.root)
+        blobs = [string.encode('utf-8') for string in strings.strings[1:]]
+        string_offsets = array('I', [0, 0])
+        for blob in blobs:
+            string_offsets.append(string_offsets[-1] + len(blob))
+        sorted_people = array('I', sorted(range(len(self.ids)), key=lambda i: self.ids[i]))
+        last_names = sorted(self.by_last_name)
+        last_name_offsets = array('I', [0])
+        last_name_people = array('I')
+        for key in last_names:
+            last_name_people.extend(self.by_last_name[key])
+            last_name_offsets.append(len(last_name_people))
+        details = json.dumps({i: d for i, d in self.details.items()}).encode('utf-8')
+
+        arrays = [string_offsets, id_strings] + [self.columns[column] for column in NAME_COLUMNS] + \
+                 [self.edge_parents, self.edge_children, children_offsets, children, parents_offsets, parents,
+                  sorted_people, array('I', last_names), last_name_offsets, last_name_people]
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, BYTE_ORDER, root, len(self.ids), len(strings),
+                                string_offsets[-1], len(self.edge_parents), len(last_names), len(details)))
+            for a in arrays:
+                f.write(a.tobytes() if isinstance(a, array) else array('I', a).tobytes())
+            f.writelines(blobs)
+            f.write(details)
+
+    @classmethod
+    def load(cls, path) -> 'FamilyTree':
+        """Memory-maps a saved tree; nothing is decoded until it is accessed, and it is copied on first change."""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byte_order, root, people, strings, string_bytes, edges, last_names, details_bytes = \
+            HEADER.unpack_from(mapped)
+        if magic != MAGIC or byte_order != BYTE_ORDER:
+            raise Exception(f'{path} is not a family tree saved on this platform')
+        view = memoryview(mapped)
+        position = HEADER.size
+
+        def take(count):
+            nonlocal position
+            section = view[position:position + 4 * count].cast('I')
+            position += 4 * count
+            return section
+
+        string_offsets = take(strings + 1)
+        id_strings = take(people)
+        columns = {column: take(people) for column in NAME_COLUMNS}
+        edge_parents, edge_children = take(edges), take(edges)
+        children_offsets, children = take(people + 1), take(edges)
+        parents_offsets, parents = take(people + 1), take(edges)
+        sorted_people = take(people)
+        last_name_keys, last_name_offsets = take(last_names), take(last_names + 1)
+        last_name_people = take(last_name_offsets[-1] if last_names else 0)
+        blob = view[position:position + string_bytes]
+        details = json.loads(bytes(view[position + string_bytes:position + string_bytes + details_bytes]))
+
+        tree = cls.__new__(cls)
+        tree.strings = MappedStrings(string_offsets, blob)
+        tree.root = tree.strings[root]
+        tree.ids = MappedIds(tree.strings, id_strings)
+        tree.index = MappedIndex(tree.ids, sorted_people)
+        tree.columns = columns
+        tree.details = {int(i): d for i, d in details.items()}
+        tree.by_last_name = MappedGroups(last_name_keys, last_name_offsets, last_name_people)
+        tree.edge_parents, tree.edge_children = edge_parents, edge_children
+        tree.csr = {'children': (children_offsets, children), 'parents': (parents_offsets, parents)}
+        tree.pending_edges, tree.pending_parents, tree.pending_children = {}, {}, {}
+        tree.mapped = mapped
+        return tree
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'root': self.root,
+                       'people': [dict(self.data(person_id)._asdict(), parents=self.parents(person_id))
+                                  for person_id in self]}, f)
+
+    def parent_roles(self, parent_sets) -> Dict[int, str]:
+        """
+        HUSB or WIFE for every parent, the same in all their families. There is no sex data, so parents of a child
+        get opposite roles where possible, by coloring the graph of co-parents breadth first.
+        """
+        co_parents = {}
+        for parents in parent_sets:
+            for p in parents:
+                co_parents.setdefault(p, set()).update(q for q in parents if q != p)
+        roles = {}
+        for start in co_parents:
+            if start in roles:
+                continue
+            roles[start] = 'HUSB'
+            queue = deque([start])
+            while queue:
+                p = queue.popleft()
+                for q in co_parents[p]:
+                    if q not in roles:
+                        roles[q] = 'WIFE' if roles[p] == 'HUSB' else 'HUSB'
+                        queue.append(q)
+        return roles
+
+    def export_gedcom(self, path):
+        """
+        Exports INDI records and one FAM record per distinct set of parents; partners without children are lost. A
+        set of parents that cannot be one HUSB and one WIFE is split into more families with the same children.
+        """
+        children_of = {}
+        for i in range(len(self.ids)):
+            parents = tuple(self.parent_indices(i))
+            if parents:
+                children_of.setdefault(parents, []).append(i)
+        roles = self.parent_roles(children_of)
+        families = []  # (husband, wife, children), either parent may be None
+        for parents, children in children_of.items():
+            husbands = [p for p in parents if roles[p] == 'HUSB']
+            wives = [p for p in parents if roles[p] == 'WIFE']
+            for n in range(max(len(husbands), len(wives))):
+                families.append((husbands[n] if n < len(husbands) else None, wives[n] if n < len(wives) else None,
+                                 children))
+        spouse_of = {}
+        family_of = {}
+        for f, (husband, wife, children) in enumerate(families):
+            for p in [husband, wife]:
+                if p is not None:
+                    spouse_of.setdefault(p, []).append(f)
+            for child in children:
+                family_of.setdefault(child, []).append(f)
+
+        with open(path, 'w') as f:
+            f.write('0 HEAD\n1 GEDC\n2 VERS 5.5.1\n2 FORM LINEAGE-LINKED\n1 CHAR UTF-8\n')
+            for i in range(len(self.ids)):
+                data = self.data(self.ids[i])
+                f.write(f'0 @I{i}@ INDI\n1 NAME {data.first_name or ""} /{data.last_name or ""}/\n')
+                f.write(f'1 REFN {data.id}\n')
+                for family in family_of.get(i, []):
+                    f.write(f'1 FAMC @F{family}@\n')
+                for family in spouse_of.get(i, []):
+                    f.write(f'1 FAMS @F{family}@\n')
+            for family, (husband, wife, children) in enumerate(families):
+                f.write(f'0 @F{family}@ FAM\n')
+                for tag, p in [('HUSB', husband), ('WIFE', wife)]:
+                    if p is not None:
+                        f.write(f'1 {tag} @I{p}@\n')
+                for child in children:
+                    f.write(f'1 CHIL @I{child}@\n')
+            f.write('0 TRLR\n')
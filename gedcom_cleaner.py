@@ -1,4 +1,12 @@
-from typing import List
+import io
+import json
+import mmap
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 FORM_KEYS_ = {
     'CTRY': 'Country',
@@ -7,26 +15,98 @@ FORM_KEYS_ = {
     'POST': 'Postal Code',
 }
 
+ADDRESS_EVENTS = ['BIRT', 'DEAT', 'BURI', 'RESI']
+
+CHUNK_SIZE = 4 * 2 ** 20
+
+ADDRESS_PART = re.compile(r'^\d+ (?:' + '|'.join(FORM_KEYS_) + r')\b', re.MULTILINE)
+
+RECORD_START = re.compile(rb'(?:^|(?<=\r))(?:\xef\xbb\xbf)?0 (?:(@[^@\r\n]+@) )?([^ \r\n]*)', re.MULTILINE)
+
+INDEX_VERSION = 1
+INDEX_TAIL = 4096
+
+GedcomLine = namedtuple('GedcomLine', ['level', 'xref', 'tag', 'value'])
+IndexedRecord = namedtuple('IndexedRecord', ['xref', 'tag', 'start', 'end'])
+
+
+def parse_line(line: str) -> GedcomLine:
+    """Splits `level [@xref@] tag [value]`; the value keeps inner spaces but not the line ending."""
+    parts = line.lstrip('\ufeff ').rstrip('\r\n').split(' ', 2)
+    level = int(parts[0]) if parts[0].isdigit() else -1
+    xref = None
+    if len(parts) > 1 and parts[1][:1] == '@':
+        xref = parts[1]
+        parts = parts[:1] + parts[2].split(' ', 1) if len(parts) > 2 else parts[:1] + ['']
+    tag = parts[1] if len(parts) > 1 else ''
+    value = parts[2] if len(parts) > 2 else ''
+    return GedcomLine(level=level, xref=xref, tag=tag, value=value)
+
+
+def line_tag(line: str) -> str:
+    """Just the tag of a line, cheaper than parse_line for deciding whether a structure needs parsing at all."""
+    parts = line.split(None, 3)
+    if len(parts) > 2 and parts[1][:1] == '@':
+        return parts[2]
+    return parts[1] if len(parts) > 1 else ''
+
+
+def line_ending(line: str) -> str:
+    return '\r\n' if line.endswith('\r\n') else '\n'
+
+
+def parse_gedcom(lines: Iterable[str]) -> Iterator[GedcomLine]:
+    for line in lines:
+        if line.strip():
+            yield parse_line(line)
+
+
+def iter_records(lines: Iterable[str]) -> Iterator[List[str]]:
+    """Groups raw lines into level 0 records (HEAD, INDI, FAM, ...), holding one record at a time."""
+    record = []
+    for line in lines:
+        if line.startswith('0 ') and record:
+            yield record
+            record = []
+        record.append(line)
+    if record:
+        yield record
+
+
+def full_value(parsed: List[GedcomLine], i) -> str:
+    """The value of parsed[i] with its CONC/CONT continuation lines joined."""
+    value = parsed[i].value
+    for line in parsed[i + 1:]:
+        if line.level != parsed[i].level + 1 or line.tag not in ['CONC', 'CONT']:
+            break
+        value += ('' if line.tag == 'CONC' else '\n') + line.value
+    return value
+
 
 def process_event(event_lines: List[str]) -> List[str]:
-    if not event_lines:
-        return event_lines
-    event_type = event_lines[0].strip().lstrip('1').strip()
-    if event_type not in ['BIRT', 'DEAT', 'BURI', 'RESI']:
+    if not event_lines or line_tag(event_lines[0]) not in ADDRESS_EVENTS:
         return event_lines
+    parsed = [parse_line(line) for line in event_lines]
     address_keys = []
     address_vals = []
     place = None
     event_lines_to_keep = []
-    for i, line in enumerate(event_lines):
-        key, value = line[2:6].strip(), line[7:].strip()
+    continued = None
+    for i, (line, parsed_line) in enumerate(zip(event_lines, parsed)):
+        key = parsed_line.tag
+        if continued is not None and parsed_line.level == continued + 1 and key in ['CONC', 'CONT']:
+            continue
+        continued = None
         if key == 'PLAC':
-            place = value
-        elif key == 'ADDR' or key == 'CONT':
+            place = full_value(parsed, i)
+            continued = parsed_line.level
+        elif key == 'ADDR':
+            continued = parsed_line.level
+        elif key == 'CONT':
             pass
         elif key in FORM_KEYS_.keys():
             address_keys.append(FORM_KEYS_[key])
-            address_vals.append(value)
+            address_vals.append(parsed_line.value.strip())
         else:
             event_lines_to_keep.append(line)
     if not address_vals:
@@ -34,36 +114,181 @@ def process_event(event_lines: List[str]) -> List[str]:
     updated_place = ', '.join(address_vals)
     form = ', '.join(address_keys)
     if place:
-        updated_place = place + ', ' + updated_place
+        updated_place = place.strip() + ', ' + updated_place
         form = 'Other, ' + form
-    event_lines_to_keep.append('2 PLAC ' + updated_place + '\n')
-    event_lines_to_keep.append('3 FORM ' + form + '\n')
+    ending = line_ending(event_lines[0])
+    event_lines_to_keep.append('2 PLAC ' + updated_place + ending)
+    event_lines_to_keep.append('3 FORM ' + form + ending)
     return event_lines_to_keep
 
 
-def process_person(person_lines: List[str]) -> List[str]:
+def iter_events(record_lines: Iterable[str]) -> Iterator[List[str]]:
+    """Splits a record into its level 0 line and its level 1 structures (events, names, ...)."""
     event_lines = []
-    updated_event_lines = []
-    for line in person_lines:
-        if line.startswith('1 '):
-            updated_event_lines += process_event(event_lines)
+    for line in record_lines:
+        if line.startswith('1 ') and event_lines:
+            yield event_lines
             event_lines = []
         event_lines.append(line)
-    updated_event_lines += event_lines
-    return updated_event_lines
+    if event_lines:
+        yield event_lines
+
+
+def merge_place_address(record_lines: List[str]) -> List[str]:
+    """Transform folding the address lines of an event into its PLAC, with a FORM naming the parts."""
+    if not ADDRESS_PART.search(''.join(record_lines)):
+        return record_lines
+    return [line for event_lines in iter_events(record_lines) for line in process_event(event_lines)]
+
+
+def process_person(person_lines: List[str]) -> List[str]:
+    return merge_place_address(person_lines)
+
+
+Transform = Callable[[List[str]], Iterable[str]]
+
+TRANSFORMS: List[Transform] = [merge_place_address]
+
+
+def process_records(lines: Iterable[str], transforms: List[Transform] = None) -> Iterator[str]:
+    transforms = TRANSFORMS if transforms is None else transforms
+    for record in iter_records(lines):
+        for transform in transforms:
+            record = list(transform(record))
+        yield from record
+
+
+def open_gedcom(path, mode='r'):
+    # Line endings are kept as they are, and undecodable bytes are passed through, so untouched records are copied
+    # byte for byte.
+    return open(path, mode, encoding='utf-8', errors='surrogateescape', newline='')
+
+
+def chunk_bounds(data, chunk_size=CHUNK_SIZE) -> Iterator[Tuple[int, int]]:
+    """Byte ranges of at least chunk_size that each start at a level 0 line, so that no record is split."""
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n0 ', start + chunk_size)
+        end = len(data) if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+def decode_lines(data: bytes) -> List[str]:
+    # Splits lines exactly like a file opened by open_gedcom.
+    return list(io.StringIO(data.decode('utf-8', 'surrogateescape'), newline=''))
+
+
+def process_chunk(inpath: str, start, end, transforms: List[Transform] = None) -> bytes:
+    with open(inpath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        lines = decode_lines(data[start:end])
+    return ''.join(process_records(lines, transforms)).encode('utf-8', 'surrogateescape')
+
+
+def process_gedcom_parallel(inpath: str, outpath: str, transforms: List[Transform] = None, processes=None):
+    """Cleans record aligned chunks of the memory-mapped input in a process pool, writing them back in order."""
+    with open(inpath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        starts, ends = zip(*chunk_bounds(data))
+    with ProcessPoolExecutor(processes) as executor, open(outpath, 'wb') as outfile:
+        for chunk in executor.map(process_chunk, repeat(inpath), starts, ends, repeat(transforms)):
+            outfile.write(chunk)
+
+
+def process_gedcom(inpath: str, outpath: str, transforms: List[Transform] = None, processes=1):
+    """With processes other than 1 (None for one per core) the file is cleaned in parallel, to the same output."""
+    if processes != 1 and os.path.getsize(inpath):
+        return process_gedcom_parallel(inpath, outpath, transforms, processes)
+    with open_gedcom(inpath) as infile:
+        with open_gedcom(outpath, 'w') as outfile:
+            outfile.writelines(process_records(infile, transforms))
+
+
+class GedcomIndex:
+    """
+    Byte ranges of the level 0 records of a GEDCOM file by xref, kept in a sidecar file next to it.
+    When the file has only been appended to since the index was saved, just the new part is scanned.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self.records: List[IndexedRecord] = []
+        self.by_xref: Dict[str, IndexedRecord] = {}
+        self.size = 0
+        self.update()
+
+    @staticmethod
+    def _tail(f, size) -> str:
+        f.seek(max(0, size - INDEX_TAIL))
+        return f.read(size - f.tell()).hex()
+
+    def _load(self) -> Optional[dict]:
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return index if index.get('version') == INDEX_VERSION else None
+
+    def _save(self, tail):
+        with open(self.index_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'size': self.size, 'tail': tail, 'records': self.records}, f)
+
+    def update(self):
+        """Brings the index up to date with the file, rebuilding it from scratch unless the file was appended to."""
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            index = self._load()
+            records = []
+            if index and index['size'] <= size and self._tail(f, index['size']) == index['tail']:
+                if index['size'] == size:
+                    self._set(index['records'], size)
+                    return
+                # The last record may have been continued by the appended lines, so it is scanned again.
+                records = [IndexedRecord(*record) for record in index['records'][:-1]]
+            start = records[-1].end if records else 0
+            if size > start:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    records.extend(self._scan(data, start))
+            self._set(records, size)
+            self._save(self._tail(f, size))
+
+    def _set(self, records, size):
+        self.records = [IndexedRecord(*record) for record in records]
+        self.by_xref = {record.xref: record for record in self.records if record.xref}
+        self.size = size
+
+    @staticmethod
+    def _scan(data, start) -> Iterator[IndexedRecord]:
+        previous = None
+        for match in RECORD_START.finditer(data, start):
+            if previous:
+                yield previous._replace(end=match.start())
+            xref = match.group(1).decode('utf-8', 'surrogateescape') if match.group(1) else None
+            previous = IndexedRecord(xref=xref, tag=match.group(2).decode('utf-8', 'surrogateescape'),
+                                     start=match.start(), end=None)
+        if previous:
+            yield previous._replace(end=len(data))
+
+    def __contains__(self, xref):
+        return xref in self.by_xref
+
+    def read(self, records: Iterable[IndexedRecord]) -> Iterator[List[str]]:
+        """The lines of each record, read in file order."""
+        with open(self.path, 'rb') as f:
+            for record in sorted(records, key=lambda r: r.start):
+                f.seek(record.start)
+                yield decode_lines(f.read(record.end - record.start))
 
+    def record(self, xref) -> List[str]:
+        return next(self.read([self.by_xref[xref]]))
 
-def process_gedcom(inpath: str, outpath: str):
-    person_lines = []
-    with open(inpath, 'r') as infile:
-        with open(outpath, 'w') as outfile:
-            for line in infile:
-                if line.startswith('0 ') and line.endswith('INDI\n'):
-                    outfile.writelines(process_person(person_lines))
-                    person_lines = []
-                person_lines.append(line)
-            outfile.writelines(person_lines)
+    def iter_records(self, xrefs: Iterable[str] = None, tag=None) -> Iterator[List[str]]:
+        """The records with the given xrefs and/or tag (INDI, FAM, ...), without parsing the rest of the file."""
+        records = self.records if xrefs is None else [self.by_xref[xref] for xref in xrefs]
+        return self.read(record for record in records if tag is None or record.tag == tag)
 
 
 if __name__ == '__main__':
-    process_gedcom('/Users/xx/Downloads/export-BloodTree-6.ged', '/Users/xx/Downloads/export-BloodTree-6-out.ged')
+    process_gedcom('/Users/xx/Downloads/export-BloodTree-6.ged', '/Users/xx/Downloads/export-BloodTree-6-out.ged',
+                   processes=None)
@@ -0,0 +1,135 @@
+import mmap
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from family_tree import FamilyTree, PersonData
+from gedcom_cleaner import chunk_bounds, parse_line
+
+PARENT_TAGS = ['HUSB', 'WIFE', 'FAMS']
+CHILD_TAGS = ['CHIL', 'FAMC']
+
+# Only the lines the tree needs are matched, so the rest of each record is skipped by the regex engine.
+FIELDS = re.compile(r'^(?:0 |1 (?:NAME|REFN|' + '|'.join(PARENT_TAGS + CHILD_TAGS) + r')\b|2 (?:GIVN|SURN)\b)[^\n]*',
+                    re.MULTILINE)
+
+
+def parse_name(value: str):
+    """`Given names /Surname/ suffix` into first and last name."""
+    if '/' not in value:
+        return value.strip(), ''
+    first, _, rest = value.partition('/')
+    last, _, suffix = rest.partition('/')
+    return ' '.join((first + suffix).split()), last.strip()
+
+
+def person_data(person_id, first_name, last_name) -> PersonData:
+    return PersonData(id=person_id, first_name=first_name, last_name=last_name,
+                      display_name=' '.join(filter(None, [first_name, last_name])))
+
+
+def read_chunks(path) -> Iterator[str]:
+    """The decoded file in chunks of whole records, one at a time."""
+    if not os.path.getsize(path):
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for start, end in chunk_bounds(data):
+            # CRs become newlines, so that lines with any ending are matched the same way.
+            yield data[start:end].decode('utf-8', 'surrogateescape').lstrip('\ufeff').replace('\r', '\n')
+
+
+class GedcomFamilyTreeGenerator:
+    """
+    Builds a FamilyTree from a GEDCOM file instead of the Geni API. The file is read a few MiB at a time; only the
+    people and, per family, the indices of its parents and children are held until the edges are added at the end.
+    People are identified by their xref, or with use_refn by their REFN, which FamilyTree.export_gedcom sets to the
+    profile id but is a free-form reference in other files.
+    """
+
+    def __init__(self, path, use_refn=False):
+        self.path = path
+        self.use_refn = use_refn
+        self.family_tree: Optional[FamilyTree] = None
+        self.people: Dict[str, int] = {}
+        self.family_parents: Dict[str, List[int]] = {}
+        self.family_children: Dict[str, List[int]] = {}
+        self.pending: List[Tuple[str, str, str]] = []  # family links to people that were not read yet
+
+    def reset(self):
+        self.__init__(self.path, self.use_refn)
+
+    def link(self, tag, family, person):
+        if person not in self.people:
+            self.pending.append((tag, family, person))
+            return
+        members = self.family_parents if tag in PARENT_TAGS else self.family_children
+        members.setdefault(family, []).append(self.people[person])
+
+    def add_person(self, xref, data: PersonData, links, root_id):
+        if self.family_tree is None:
+            self.family_tree = FamilyTree(root=root_id or data.id)
+        if data.id in self.family_tree:
+            raise Exception(f'Two individuals in {self.path} have the id {data.id}, the second is {xref}')
+        self.people[xref] = self.family_tree.add_person(data)
+        for tag, family in links:
+            self.link(tag, family, xref)
+
+    def read_records(self, root_id):
+        kind = xref = None
+        person_id = first_name = last_name = None
+        names = 0
+        links = []
+        for text in read_chunks(self.path):
+            for line in FIELDS.findall(text):
+                tag, value = line[2:6], line[7:].strip()
+                if line[0] == '1':
+                    if kind == 'INDI':
+                        if tag == 'NAME':
+                            names += 1
+                            if names == 1:
+                                first_name, last_name = parse_name(value)
+                        elif tag == 'REFN':
+                            if self.use_refn:
+                                person_id = value or person_id
+                        else:
+                            links.append((tag, value))
+                    elif kind == 'FAM' and tag != 'NAME' and tag != 'REFN':
+                        self.link(tag, xref, value)
+                elif line[0] == '2':
+                    if kind == 'INDI' and names == 1:
+                        if tag == 'GIVN':
+                            first_name = value
+                        else:
+                            last_name = value
+                else:
+                    if kind == 'INDI':
+                        self.add_person(xref, person_data(person_id, first_name, last_name), links, root_id)
+                    head = parse_line(line)
+                    xref, kind = head.xref, head.tag
+                    person_id, first_name, last_name = xref, '', ''
+                    names = 0
+                    links = []
+        if kind == 'INDI':
+            self.add_person(xref, person_data(person_id, first_name, last_name), links, root_id)
+
+    def generate_tree(self, root_id=None) -> FamilyTree:
+        """
+        :param root_id: id of the root person, by default the first person in the file
+        :rtype FamilyTree
+        """
+        self.reset()
+        self.read_records(root_id)
+        if self.family_tree is None:
+            raise Exception('No individuals in ' + self.path)
+        for tag, family, person in self.pending:
+            if person in self.people:
+                self.link(tag, family, person)
+
+        family_tree = self.family_tree
+        ids = family_tree.ids
+        for family, children in self.family_children.items():
+            parents = set(self.family_parents.get(family, []))  # listed in both the INDI and the FAM record
+            for child in set(children):
+                for parent in parents:
+                    family_tree.add_parent(ids[child], ids[parent])
+        return family_tree
@@ -1,32 +1,22 @@
-from collections import namedtuple
-from functools import partial
-from typing import Optional
+import copy
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
+from typing import Callable, Dict, FrozenSet, List, Tuple, Union
 
 import unidecode as unidecode
 
-from geni_api import GeniApi
+from geni_api import GeniApi, MAX_IDS_PER_REQUEST, profile_results
+from geni_commands import Commands, FileCommand, MONTHS, PlanBlock, ProfileIndex, parse_commands, plan_blocks, \
+    plan_commands, root_id, validate_commands
 from known_cities import KNOWN_CITIES
+from update_journal import UpdateJournal
+from iter_utils import chunks
 from update_lib import update_items, Update, Updater
 
 ProfileAdd = namedtuple('ProfileAdd', ['profile_id', 'profile', 'method'])
 
 
-class Commands:
-    END_NEW = 'end_new'
-    POP_ROOTS = 'pop_roots'
-    POP_ROOT = 'pop_root'
-    PUSH_ROOT = 'push_root'
-    SET_ROOT = 'set_root'
-    UPDATE_PROFILE = 'update_profile'
-    ADD_CHILDREN = 'add_children'
-    ADD_PARTNER = 'add_partner'
-    ADD_PARENTS = 'add_parents'
-    ADD_TREE = 'add_tree'
-    ADD_MARRIAGE = 'add_marriage'
-
-
-COMMANDS = Commands.__dict__.values()
-
 GENI_APIS = {
     Commands.ADD_TREE: 'add',
     Commands.ADD_PARENTS: 'add-parent',
@@ -35,8 +25,6 @@ GENI_APIS = {
     Commands.UPDATE_PROFILE: 'update',
 }
 
-MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
-
 DEFAULTS = {
     'living': False,
 }
@@ -51,6 +39,10 @@ DICTS = {
 
 BASE_PROFILE_FIELDS = ['id', 'about_me', 'last_name', 'maiden_name', 'nicknames', 'name']
 
+DEFAULT_PREFETCH_WORKERS = 8
+
+ADD_BATCH_SIZE = 1000
+
 
 def key_from_file(key, file_info):
     if key in file_info:
@@ -77,35 +69,49 @@ def age_extractor(file_info):
         return {'birth[date][year]': age_years}
 
 
+# Transcribed records repeat the same surnames, dates and towns, so their parsed forms are memoized.
+@lru_cache(maxsize=2 ** 16)
+def split_name(unsplit, parts) -> Tuple[str, ...]:
+    if ',' in unsplit:
+        split = unsplit.split(',', maxsplit=parts - 1)
+    elif '(' in unsplit and unsplit.endswith(')'):
+        split = reversed(unsplit.strip()[:-1].split('(', maxsplit=parts - 1))
+    else:
+        split = unsplit
+    return tuple(v.strip() for _, v in zip(range(parts), split))
+
+
+@lru_cache(maxsize=2 ** 16)
+def event_date(event, value) -> Dict[str, int]:
+    day, month, year = value.split('-')
+    return {
+        f'{event}[date][year]': int(year),
+        f'{event}[date][month]': MONTHS.index(month.lower()[:3]) + 1,
+        f'{event}[date][day]': int(day),
+    }
+
+
+@lru_cache(maxsize=2 ** 12)
+def event_location(event, event_town) -> Dict[str, str]:
+    event_town_decoded = unidecode.unidecode(event_town)
+    if event_town_decoded in KNOWN_CITIES:
+        return {f'{event}[location][{key}]': value for key, value in KNOWN_CITIES[event_town_decoded].items()}
+    return {f'{event}[location][city]': event_town}
+
+
 def name_extractor(key, split_keys, file_info):
     if key in file_info:
-        unsplit = file_info[key]
-        if ',' in unsplit:
-            split = unsplit.split(',', maxsplit=len(split_keys) - 1)
-        elif '(' in unsplit and unsplit.endswith(')'):
-            split = reversed(unsplit.strip()[:-1].split('(', maxsplit=len(split_keys) - 1))
-        else:
-            split = unsplit
-        return {k: v.strip() for k, v in zip(split_keys, split)}
+        return dict(zip(split_keys, split_name(file_info[key], len(split_keys))))
 
 
 def event_extractor(event, file_info):
     geni_data = {}
 
     if f'{event}_date' in file_info:
-        day, month, year = file_info[f'{event}_date'].split('-')
-        geni_data[f'{event}[date][year]'] = int(year)
-        geni_data[f'{event}[date][month]'] = MONTHS.index(month.lower()[:3]) + 1
-        geni_data[f'{event}[date][day]'] = int(day)
+        geni_data.update(event_date(event, file_info[f'{event}_date']))
 
     if f'{event}_town' in file_info:
-        event_town = file_info[f'{event}_town']
-        event_town_decoded = unidecode.unidecode(event_town)
-        if event_town_decoded in KNOWN_CITIES:
-            for key, value in KNOWN_CITIES[event_town_decoded].items():
-                geni_data[f'{event}[location][{key}]'] = value
-        else:
-            geni_data[f'{event}[location][city]'] = event_town
+        geni_data.update(event_location(event, file_info[f'{event}_town']))
 
     return geni_data
 
@@ -133,23 +139,49 @@ DATA_UPDATERS = {
 }
 
 
+@lru_cache(maxsize=None)
+def compiled_extractors(keys: FrozenSet[str]) -> tuple:
+    """The DATA_EXTRACTORS that can extract anything from records with these keys, e.g. birth for birth_town."""
+    return tuple(extractor for key, extractor in DATA_EXTRACTORS
+                 if key in keys or key in DEFAULTS or any(k.startswith(key + '_') for k in keys))
+
+
+def extract_profile(file_profile: dict) -> dict:
+    """Geni fields of a record, running only the extractors for the keys present in records of its shape."""
+    profile = {}
+    for extractor in compiled_extractors(frozenset(file_profile)):
+        profile.update(extractor(file_profile) or {})
+    for updater in DATA_UPDATERS:
+        for key, value in profile.items():
+            profile[key] = updater(key, value)
+    return profile
+
+
+def extract_profiles(file_profiles: List[dict]) -> List[dict]:
+    return [extract_profile(file_profile) for file_profile in file_profiles]
+
+
 class ProfileAdder(Updater):
+    update_type = ProfileAdd
+
     def __init__(self, geni_api: GeniApi, command, base_profile, union_id=None):
         self.geni_api = geni_api
         self.command = command
         self.base_profile = base_profile
         self.union_id = union_id
 
-    def get_update(self, file_profile) -> Optional[Update]:
-        profile = {}
-
-        for key, extractor in DATA_EXTRACTORS:
-            profile.update(extractor(file_profile) or {})
-
-        for updater in DATA_UPDATERS:
-            for key, value in profile.items():
-                profile[key] = updater(key, value)
-
+    def get_updates(self, file_profiles: List[dict]) -> List[Union[Update, Exception]]:
+        """One update per record, or the exception for a record that could not be converted."""
+        updates = []
+        for file_profile in file_profiles:
+            try:
+                updates.append(self.profile_update(extract_profile(file_profile)))
+            except Exception as e:
+                print('Failed to get update for', file_profile, e)
+                updates.append(e)
+        return updates
+
+    def profile_update(self, profile) -> Update:
         # merge with base logic
         if self.command == Commands.UPDATE_PROFILE:
             if 'nicknames' in profile and 'nicknames' in self.base_profile:
@@ -176,72 +208,116 @@ class ProfileAdder(Updater):
 
 
 class FileProcessor:
-    def __init__(self):
+    def __init__(self, journal_path=None, approve: Callable[[Update], bool] = None):
+        """
+        :param journal_path: UpdateJournal file; running a file again then skips the profiles already added
+        :param approve: policy deciding each profile to add instead of asking for confirmation, see update_items;
+            needed to run blocks of the file concurrently
+        """
         self.geni_api = GeniApi(dry_run=False)
+        self.journal = UpdateJournal(journal_path) if journal_path else None
+        self.approve = approve
         self.current_base_profile = None
         self.current_union_id = None
         self.base_profile_stack = []
-        self.all_profiles_added = []
-
-    def process_file(self, filename):
-        current_info = {}
-        current_infos = []
+        self.all_profiles_added = ProfileIndex()
+        self.root_profiles: Dict[str, dict] = {}  # set_root profiles fetched ahead, by profile id
+        self.partner_unions: Dict[str, List[str]] = {}  # unions of set_root profiles fetched ahead, by profile id
 
+    def process_file(self, filename, workers=1):
+        """:param workers: number of independent blocks of the file (see plan_blocks) to run at a time"""
         with open(filename, 'r') as f:
-            line_number = 0
-            for line in f:
-                line_number += 1
-                line = line.strip()
-
-                if line.startswith('#'):
-                    continue
-
-                if line and line not in COMMANDS and ': ' not in line:
-                    raise Exception(f'Bad line {line_number}: {line}')
-                if line == Commands.END_NEW:
-                    break
-
-        current_command = None
-        with open(filename, 'r') as f:
-            for line in f:
-                line = line.strip()
-
-                if line in COMMANDS:
-                    if line == Commands.END_NEW:
-                        break
-                    if current_command:
-                        self.run_command(current_command, current_infos)
-                        current_infos = []
-                    current_command = line
-                elif not line and current_info:
-                    current_infos.append(current_info)
-                    current_info = {}
-                else:
-                    elements = line.split(':', maxsplit=1)
-                    if len(elements) == 2:
-                        current_info[elements[0]] = elements[1].strip()
-
-            if current_info:
-                current_infos.append(current_info)
-            if current_infos:
-                self.run_command(current_command, current_infos)
-
-        # run command
+            commands = parse_commands(f)
+        errors = validate_commands(commands)
+        if errors:
+            raise Exception(f'{filename} has {len(errors)} errors:\n' + '\n'.join(errors))
+        planned = plan_commands(commands)
+        self.prefetch_roots(planned)
+        if workers > 1 and not self.approve:
+            print('Running one block at a time, so that each can be confirmed')
+            workers = 1
+        if workers == 1:
+            for command in planned:
+                self.run_command(command.name, [record.fields for record in command.records])
+        else:
+            self.run_blocks(plan_blocks(planned), workers)
+
+    def prefetch_roots(self, planned: List[FileCommand]):
+        """
+        Fetches the profiles of the set_root ids MAX_IDS_PER_REQUEST at a time, and the unions of those that get
+        children right away, instead of one blocking request per set_root and add_children. Roots that are set more
+        than once may be updated in between, so they are fetched when they are set.
+        """
+        roots = Counter(root_id(command) for command in planned if root_id(command))
+        once = [root for root, count in roots.items() if count == 1]
+        for chunk in chunks([f'profile-g{root}' for root in once], MAX_IDS_PER_REQUEST):
+            for profile in profile_results(self.geni_api.get_profiles(chunk, fields=BASE_PROFILE_FIELDS + ['guid'])):
+                if str(profile.get('guid')) in once:
+                    self.root_profiles[f'profile-g{profile["guid"]}'] = profile
+
+        profile_ids = []
+        for i, command in enumerate(planned[:-1]):
+            root = root_id(command)
+            if root and roots[root] == 1 and planned[i + 1].name == Commands.ADD_CHILDREN:
+                profile = self.root_profiles.get(f'profile-g{root}')
+                if profile and 'id' in profile:
+                    profile_ids.append(profile['id'])
+        with ThreadPoolExecutor(DEFAULT_PREFETCH_WORKERS) as executor:
+            self.partner_unions.update(zip(profile_ids, executor.map(self.geni_api.get_partner_unions, profile_ids)))
+
+    def fork(self):
+        """
+        A processor for one block, sharing the API, journal and fetched profiles but with roots of its own. Its added
+        profiles go into an index of their own on top of this one's, which run_blocks merges back in file order.
+        """
+        processor = copy.copy(self)
+        processor.current_base_profile = None
+        processor.current_union_id = None
+        processor.base_profile_stack = []
+        processor.all_profiles_added = ProfileIndex(base=self.all_profiles_added)
+        return processor
+
+    def run_block(self, block: PlanBlock):
+        """:return: the profiles added by the block"""
+        added_before = len(self.all_profiles_added)
+        for command in block.commands:
+            self.run_command(command.name, [record.fields for record in command.records])
+        return self.all_profiles_added.entries[added_before:]
+
+    def run_blocks(self, blocks: List[PlanBlock], workers):
+        """
+        Runs up to `workers` blocks at a time, each as soon as the blocks it depends on are done. The profiles they
+        add are collected in file order, so a set_root without an id matches the same profile as when run in order.
+        """
+        added = {}  # by block index, until merged
+        waiting = list(range(len(blocks)))
+        running = {}
+        merged = 0
+        with ThreadPoolExecutor(workers) as executor:
+            while waiting or running:
+                for i in [i for i in waiting if all(j < merged or j in added for j in blocks[i].after)]:
+                    waiting.remove(i)
+                    running[executor.submit(self.fork().run_block, blocks[i])] = i
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    added[running.pop(future)] = future.result()
+                while merged in added:
+                    self.all_profiles_added.extend(added.pop(merged))
+                    merged += 1
 
     def set_root(self, info):
         self.set_base_profile(None)
         if 'id' in info:
             profile_id = 'profile-g' + info['id']
-            self.set_base_profile(self.geni_api.get_profile(profile_id, fields=BASE_PROFILE_FIELDS))
+            profile = self.root_profiles.pop(profile_id, None) or \
+                self.geni_api.get_profile(profile_id, fields=BASE_PROFILE_FIELDS)
+            self.set_base_profile(profile)
         else:
-            for profile_keys, profile in self.all_profiles_added:
-                all_keys_match = True
-                for key, value in info.items():
-                    if key not in profile_keys or profile_keys[key] != value:
-                        all_keys_match = False
-                        break
-                if all_keys_match:
-                    self.set_base_profile(profile)
+            # Normally checked by validate_commands, unless a profile could not be added.
+            matches = self.all_profiles_added.find(info)
+            if len(matches) != 1:
+                raise Exception(f'set_root {info} matches {len(matches)} added profiles')
+            self.set_base_profile(matches[0][1])
 
     def set_base_profile(self, profile):
         if profile and 'id' in profile and 'about_me' not in profile:
@@ -258,7 +334,7 @@ class FileProcessor:
     def update_root_stack(self, command):
         if command == Commands.PUSH_ROOT:
             self.base_profile_stack.append(self.current_base_profile)
-            self.set_base_profile(self.all_profiles_added[-1][1])
+            self.set_base_profile(self.all_profiles_added.entries[-1][1])
         elif command == Commands.POP_ROOT:
             self.set_base_profile(self.base_profile_stack.pop())
         elif command == Commands.POP_ROOTS:
@@ -268,47 +344,10 @@ class FileProcessor:
     def add_profiles(self, command, profiles_to_add):
         profile_adder = ProfileAdder(self.geni_api, command=command,
                                      base_profile=self.current_base_profile, union_id=self.current_union_id)
-        profiles_added = update_items(profile_adder, profiles_to_add)
-        self.all_profiles_added.extend(zip(profiles_to_add, profiles_added))
-        return profiles_added
-
-    @staticmethod
-    def convert_marriage_to_profile_commands(infos):
-        info_map = {info['section']: info for info in infos}
-
-        marriage_info = info_map['marriage']
-        marriage_year = marriage_info['date'].split('-')[-1]
-
-        commands = []
-
-        groom_info = {k: v for k, v in info_map['groom'].items() if k not in ['parents']}
-        groom_info['about_me'] = marriage_info['record']
-        if 'age' in groom_info:
-            groom_info['age'] = f'{groom_info["age"]}:{marriage_year}'
-        groom_info['gender'] = 'm'
-        commands.append((Commands.ADD_TREE, groom_info))
-
-        groom_parents = info_map['groom']['parents'].split('/')
-        commands.append((Commands.ADD_PARENTS, {'first_name': groom_parents[0], 'gender': 'm'}))
-        commands.append((Commands.ADD_PARENTS, {'birth_name': groom_parents[1], 'gender': 'f'}))
-
-        bride_info = {k: v for k, v in info_map['bride'].items() if k not in ['parents']}
-        if 'age' in bride_info:
-            bride_info['age'] = f'{bride_info["age"]}:{marriage_year}'
-        bride_info['gender'] = 'f'
-        bride_info['birth_name'] = bride_info['name']
-        del bride_info['name']
-        bride_info['marriage_date'] = marriage_info['date']
-        bride_info['marriage_town'] = marriage_info['town']
-        commands.append((Commands.ADD_PARTNER, bride_info))
-
-        if 'parents' in info_map['bride']:
-            commands.append((Commands.PUSH_ROOT, {}))
-            bride_parents = info_map['bride']['parents'].split('/')
-            commands.append((Commands.ADD_PARENTS, {'first_name': bride_parents[0], 'gender': 'm'}))
-            commands.append((Commands.ADD_PARENTS, {'birth_name': bride_parents[1], 'gender': 'f'}))
-
-        return commands
+        results = [result for result in update_items(profile_adder, profiles_to_add, batch_size=ADD_BATCH_SIZE,
+                                                     approve=self.approve, journal=self.journal) if not result.error]
+        self.all_profiles_added.extend((result.key, result.result) for result in results)
+        return [result.result for result in results]
 
     def run_command(self, command, infos):
         if command == Commands.SET_ROOT:
@@ -317,16 +356,15 @@ class FileProcessor:
         elif command in [Commands.PUSH_ROOT, Commands.POP_ROOT, Commands.POP_ROOTS]:
             assert len(infos) == 0 or (len(infos) == 1 and not infos[0])
             self.update_root_stack(command)
-        elif command in [Commands.ADD_MARRIAGE]:
-            commands = self.convert_marriage_to_profile_commands(infos)
-            for command, info in commands:
-                self.run_command(command, [info])
         else:
             if command == Commands.ADD_TREE:
                 self.set_base_profile({'id': 'profile'})
                 self.base_profile_stack = []
             elif command == Commands.ADD_CHILDREN and not self.current_union_id:
-                unions = self.geni_api.get_partner_unions(self.current_base_profile['id'])
+                profile_id = self.current_base_profile['id']
+                unions = self.partner_unions.pop(profile_id, None)
+                if unions is None:
+                    unions = self.geni_api.get_partner_unions(profile_id)
                 self.current_union_id = unions[0] if len(unions) == 1 else None
             just_added = self.add_profiles(command, profiles_to_add=infos)
             if command == Commands.ADD_TREE:
@@ -334,4 +372,4 @@ class FileProcessor:
 
 
 if __name__ == '__main__':
-    FileProcessor().process_file(filename='profile.geni')
+    FileProcessor(journal_path='profile.geni.journal').process_file(filename='profile.geni')
@@ -1,48 +1,64 @@
 from collections import namedtuple
-from typing import Set, Optional, List
+from typing import Set, Optional, List, Iterable
 
-from geni_api import GeniApi
+from geni_api import GeniApi, MAX_IDS_PER_REQUEST, profile_results
+from spelling_variants import SpellingCluster, SpellingIndex
+from iter_utils import chunks
 from update_lib import update_items, Update, Updater
 
 NicknameUpdate = namedtuple('NicknameUpdate', ['profile_id', 'nicknames'])
 
+PROFILE_FIELDS = ['id', 'name', 'first_name', 'maiden_name', 'last_name', 'nicknames']
+NAME_FIELDS = ['first_name', 'last_name', 'maiden_name']
+SURNAME_FIELDS = ['last_name', 'maiden_name']
+
 
 class SpellingUpdater(Updater):
-    def __init__(self, geni_api: GeniApi, spellings: Set[str], secondary_spellings: Set[str]=None):
+    update_type = NicknameUpdate
+
+    def __init__(self, geni_api: GeniApi, spellings: Set[str] = None, secondary_spellings: Set[str] = None,
+                 clusters: Iterable[SpellingCluster] = None, phonetic=False):
+        """
+        :param clusters: more surname clusters, all matched in the same pass over the profiles
+        :param phonetic: also flag, in `review`, profiles whose surname only has the same Daitch-Mokotoff code as a
+            spelling; these are never updated
+        """
+        clusters = list(clusters or [])
+        if spellings:
+            clusters.append(SpellingCluster(spellings, secondary_spellings or set()))
         self.geni_api = geni_api
-        self.spellings = spellings
-        self.all_spellings = self.spellings.union(secondary_spellings or {})
+        self.index = SpellingIndex(clusters, phonetic)
+        self.review: List[str] = []  # profiles with a surname that only sounds like one of the clusters
 
     def get_updates(self, profile_ids: List[str]) -> List[Optional[Update]]:
-        profiles = self.geni_api.get_profiles(profile_ids,
-                                              fields=['id', 'name', 'first_name', 'maiden_name', 'last_name',
-                                                      'nicknames'])
-        updates = []
-        if 'results' not in profiles:
-            print(profiles)
-            return []
-        for profile in profiles['results']:
-            nicknames = profile['nicknames'] if 'nicknames' in profile else []
-            existing_spellings = set(nicknames)
-            for key in {'first_name', 'last_name', 'maiden_name'}:
-                if key in profile:
-                    existing_spellings.add(profile[key])
-            if not existing_spellings.intersection(self.all_spellings):
-                continue
-            leftover_spellings = self.spellings.difference(existing_spellings)
-            if not leftover_spellings:
-                continue
-            nicknames.extend(leftover_spellings)
-            updates.append(Update(message=f"{profile['id']} {profile['name']} ({existing_spellings}): {nicknames}",
-                                  update=(NicknameUpdate(profile['id'], nicknames))))
-        return updates
+        updates = {}
+        for chunk in chunks(profile_ids, MAX_IDS_PER_REQUEST):
+            for profile in profile_results(self.geni_api.get_profiles(chunk, fields=PROFILE_FIELDS)):
+                nicknames = profile.get('nicknames', [])
+                surnames = [profile[key] for key in SURNAME_FIELDS if key in profile]
+                existing_spellings = nicknames + [profile[key] for key in NAME_FIELDS if key in profile]
+                if self.index.phonetic_match(surnames):
+                    message = f"{profile['id']} {profile.get('name')} ({surnames})"
+                    print('Check the spelling of', message)
+                    self.review.append(message)
+                leftover_spellings = self.index.missing_spellings(surnames, existing_spellings)
+                if not leftover_spellings:
+                    continue
+                nicknames = nicknames + leftover_spellings
+                message = f"{profile['id']} {profile.get('name')} ({existing_spellings}): {nicknames}"
+                updates[profile['id']] = Update(message=message, update=(NicknameUpdate(profile['id'], nicknames)))
+        return [updates.get(profile_id) for profile_id in profile_ids]
 
     def do_update(self, update: NicknameUpdate):
-        self.geni_api.update_profile(update.profile_id, {'nicknames': ','.join(update.nicknames)})
+        return self.geni_api.update_profile(update.profile_id, {'nicknames': ','.join(update.nicknames)})
 
 
 if __name__ == '__main__':
     geni_api = GeniApi()
-    my_managed_profiles = geni_api.get_managed_profiles(fields=['id'])
-    ids = [f'{profile["id"]}' for profile in my_managed_profiles]
-    update_items(SpellingUpdater(geni_api, spellings={'Friedman'}, secondary_spellings={'Friedmann'}), ids, batch_size=30)
+    # get_profiles batches start while the managed profiles are still being paged through.
+    ids = (profile['id'] for profile in geni_api.iter_managed_profiles(fields=['id']))
+    spelling_updater = SpellingUpdater(geni_api, clusters=[
+        SpellingCluster(spellings={'Friedman'}, secondary_spellings={'Friedmann', 'Fridman'}),
+        SpellingCluster(spellings={'Weiszhausz', 'Weisshaus'}, secondary_spellings=set()),
+    ])
+    update_items(spelling_updater, ids, batch_size=MAX_IDS_PER_REQUEST, fetch_workers=8, apply_workers=8)
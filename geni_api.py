@@ -1,11 +1,36 @@
+import asyncio
 import time
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, List
 
 import requests
 from collections import defaultdict
 from enum import Enum
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from rate_limit import TokenBucket
+from response_cache import ResponseCache
+from iter_utils import bounded_map
 
 GENI_BASE_URL = 'https://www.geni.com/api/'
+GENI_TOKEN_URL = 'https://www.geni.com/platform/oauth/request_token'
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (3.05, 30)  # (connect, read) seconds
+DEFAULT_RETRIES = 3
+
+GENI_RATE_LIMIT = 40
+GENI_RATE_WINDOW = 10  # seconds
+RATE_LIMITED_ATTEMPTS = 4
+
+MAX_IDS_PER_REQUEST = 50
+
+DEFAULT_PREFETCH_PAGES = 4
+
+# Geni applies the quota per application, so clients share one bucket by default.
+GENI_RATE_LIMITER = TokenBucket(GENI_RATE_LIMIT, GENI_RATE_WINDOW)
 
 UnionRel = Enum('UnionRel', 'partner child')
 HumanRel = Enum('HumanRel', 'parent sibling child partner self')
@@ -31,6 +56,65 @@ def _compute_rel_to_self(self_in_union: UnionRel,
         return HumanRel.parent
 
 
+def _partner_unions(immediate_family_response):
+    # Update profile id for cases where the guid was used.
+    base_profile_id = immediate_family_response['focus']['id']
+
+    profile = immediate_family_response['nodes'][base_profile_id]
+
+    return [union_id for union_id, union in profile['edges'].items() if union['rel'] == 'partner']
+
+
+def _page_args(number, fields: List[str] = None):
+    args = {'page': number}
+    if fields:
+        args['fields'] = ','.join(fields)
+    return args
+
+
+def _page_count(page):
+    """Number of pages of a paginated response, if it says how many results there are in total."""
+    if 'total_count' not in page or not page.get('results'):
+        return None
+    return -(-page['total_count'] // len(page['results']))
+
+
+def profile_results(response):
+    # A multi-id request returns a 'results' list, except that one id returns the bare profile.
+    if 'results' in response:
+        return response['results']
+    return [response] if 'id' in response else []
+
+
+def _immediate_family(immediate_family_response):
+    # Update profile id for cases where the guid was used.
+    base_profile_id = immediate_family_response['focus']['id']
+
+    nodes = immediate_family_response['nodes']
+    profiles = _filter_node_types(nodes, 'profile')
+
+    # For each profile, figure out rel
+    union_rels = {union_id: _rel(union) for union_id, union in profiles[base_profile_id]['edges'].items()}
+
+    rels = []
+    family = defaultdict(list)
+
+    for profile_id, profile in profiles.items():
+        if profile_id == base_profile_id:
+            family[HumanRel.self] = [profile]
+            continue
+        for union_id, union in profile['edges'].items():
+            if union_id not in union_rels.keys():
+                continue
+            rel_to_self = _compute_rel_to_self(union_rels[union_id], _rel(union))
+            rels.append((profile, rel_to_self))
+
+    for rel in rels:
+        family[rel[1]].append(rel[0])
+
+    return family
+
+
 def _read_csv(file_path: str):
     data = {}
     with open(file_path, 'r') as f:
@@ -42,9 +126,25 @@ def _read_csv(file_path: str):
     return data
 
 
+def new_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES) -> requests.Session:
+    # Transport-level retries only; POSTs are retried on connection errors (never sent) but not on bad statuses,
+    # so that an add-* call is not applied twice.
+    retry = Retry(total=retries, backoff_factor=.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 class GeniApi:
-    def __init__(self, dry_run=False):
+    def __init__(self, dry_run=False, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 rate_limiter: TokenBucket = GENI_RATE_LIMITER, cache: ResponseCache = None):
         self.dry_run = dry_run
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.session = new_session(pool_size=pool_size, retries=retries)
         now = int(time.time())
         args = _read_csv('client-info')
         access_info = _read_csv('access-token')
@@ -54,7 +154,7 @@ class GeniApi:
         if 'refresh_token' in access_info:
             args['refresh_token'] = access_info['refresh_token']
             args['grant_type'] = 'refresh_token'
-        response = requests.get('https://www.geni.com/platform/oauth/request_token', args)
+        response = self.session.get(GENI_TOKEN_URL, params=args, timeout=self.timeout)
         j = response.json()
         self.access_token = j['access_token']
         j['expiry'] = now + j['expires_in']
@@ -65,27 +165,50 @@ class GeniApi:
         if self.dry_run:
             print(method, api, args)
             return {}
-        time.sleep(.25)  # rate limit to 40/10s
         args['access_token'] = self.access_token
         url = f'{GENI_BASE_URL}{api}'
-        response = method(url, args)
-        for i in range(1, 4):
-            if response.status_code == 200:
+        for attempt in range(RATE_LIMITED_ATTEMPTS):
+            self.rate_limiter.acquire()
+            response = self._send(method, url, args)
+            self.rate_limiter.update_from_headers(response.headers)
+            if response.status_code != 429:
                 break
-            if response.status_code == 429:
-                time.sleep(i)
-            response = method(url, args)
+            self.rate_limiter.backoff(response.headers, attempt)
+        return self._check_response(method, url, args, response)
+
+    @staticmethod
+    def _check_response(method, url, args, response):
         if response.status_code != 200:
             print(method, url, args, response.json())
         response.raise_for_status()
         return response.json()
 
-    def get(self, api, args=None):
+    def _send(self, method, url, args):
+        if method == 'GET':
+            return self.session.get(url, params=args, timeout=self.timeout)
+        return self.session.post(url, data=args, timeout=self.timeout)
+
+    def _cached(self, api, args, cached=True):
+        if cached and self.cache and not self.dry_run:
+            return self.cache.get(api, args)
+
+    def _cache(self, method, api, args, response):
+        if self.cache and not self.dry_run:
+            if method == 'GET':
+                self.cache.put(api, args, response)
+            else:
+                self.cache.invalidate_post(api, response)
+        return response
+
+    def get(self, api, args=None, cached=True):
         args = args or {}
-        return self._request(requests.get, api, args)
+        cached = self._cached(api, args, cached)
+        if cached is not None:
+            return cached
+        return self._cache('GET', api, args, self._request('GET', api, args))
 
     def post(self, api, args):
-        return self._request(requests.post, api, args)
+        return self._cache('POST', api, args, self._request('POST', api, args))
 
     def get_profile(self, profile_id='profile', fields=None):
         args = {}
@@ -93,66 +216,147 @@ class GeniApi:
             args['fields'] = ','.join(fields)
         return self.get(profile_id, args)
 
-    def get_profiles(self, profile_ids, fields=None):
+    def get_profiles(self, profile_ids, fields=None, cached=True):
         args = {}
         if fields:
             args['fields'] = ','.join(fields)
         args['ids'] = ','.join(profile_ids)
-        return self.get('profile', args)
+        return self.get('profile', args, cached=cached)
 
     def update_profile(self, profile_id, fields):
-        self.post(f'{profile_id}/update-basics', fields)
+        return self.post(f'{profile_id}/update-basics', fields)
 
     def get_partner_unions(self, profile_id):
-        j = self.get(f'{profile_id}/immediate-family')
-
-        # Update profile id for cases where the guid was used.
-        base_profile_id = j['focus']['id']
-
-        profile = j['nodes'][base_profile_id]
-
-        return [union_id for union_id, union in profile['edges'].items() if union['rel'] == 'partner']
+        return _partner_unions(self.get(f'{profile_id}/immediate-family'))
 
     def get_immediate_family(self, base_profile_id):
-        j = self.get(f'{base_profile_id}/immediate-family')
-
-        # Update profile id for cases where the guid was used.
-        base_profile_id = j['focus']['id']
-
-        nodes = j['nodes']
-        profiles = _filter_node_types(nodes, 'profile')
+        return _immediate_family(self.get(f'{base_profile_id}/immediate-family'))
+
+    def iter_managed_profiles(self, fields: List[str] = None, prefetch=DEFAULT_PREFETCH_PAGES) -> Iterator[dict]:
+        """
+        Yields managed profiles page by page as they arrive. Once the first page gives the total count, up to
+        `prefetch` of the following pages are requested concurrently.
+        """
+        page = self.get('user/managed-profiles', args=_page_args(1, fields))
+        yield from page.get('results', [])
+        page_count = _page_count(page)
+        if page_count is None:
+            number = 1
+            while 'next_page' in page:
+                number += 1
+                page = self.get('user/managed-profiles', args=_page_args(number, fields))
+                yield from page.get('results', [])
+            return
+        with ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='geni-pages') as executor:
+            pages = bounded_map(executor, lambda number: self.get('user/managed-profiles', _page_args(number, fields)),
+                                range(2, page_count + 1), prefetch)
+            for page in pages:
+                yield from page.get('results', [])
+
+    def get_managed_profiles(self, fields: List[str] = None) -> List[dict]:
+        return list(self.iter_managed_profiles(fields))
+
+
+class AsyncGeniApi:
+    """Asyncio mirror of GeniApi, sharing its session, token and rate limiter, with at most `max_in_flight` requests."""
+
+    def __init__(self, geni_api: GeniApi = None, max_in_flight=DEFAULT_POOL_SIZE):
+        self.geni_api = geni_api or GeniApi(pool_size=max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='geni')
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def _in_flight(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _request(self, method, api, args):
+        geni_api = self.geni_api
+        if geni_api.dry_run:
+            print(method, api, args)
+            return {}
+        args['access_token'] = geni_api.access_token
+        url = f'{GENI_BASE_URL}{api}'
+        loop = asyncio.get_running_loop()
+        async with self._in_flight():
+            for attempt in range(RATE_LIMITED_ATTEMPTS):
+                await geni_api.rate_limiter.acquire_async()
+                response = await loop.run_in_executor(self.executor, geni_api._send, method, url, args)
+                geni_api.rate_limiter.update_from_headers(response.headers)
+                if response.status_code != 429:
+                    break
+                geni_api.rate_limiter.backoff(response.headers, attempt)
+        return geni_api._check_response(method, url, args, response)
+
+    async def get(self, api, args=None, cached=True):
+        args = args or {}
+        cached = self.geni_api._cached(api, args, cached)
+        if cached is not None:
+            return cached
+        return self.geni_api._cache('GET', api, args, await self._request('GET', api, args))
 
-        # For each profile, figure out rel
-        union_rels = {union_id: _rel(union) for union_id, union in profiles[base_profile_id]['edges'].items()}
+    async def post(self, api, args):
+        return self.geni_api._cache('POST', api, args, await self._request('POST', api, args))
 
-        rels = []
-        family = defaultdict(list)
+    async def get_profile(self, profile_id='profile', fields=None):
+        args = {}
+        if fields:
+            args['fields'] = ','.join(fields)
+        return await self.get(profile_id, args)
 
-        for profile_id, profile in profiles.items():
-            if profile_id == base_profile_id:
-                family[HumanRel.self] = [profile]
-                continue
-            for union_id, union in profile['edges'].items():
-                if union_id not in union_rels.keys():
-                    continue
-                rel_to_self = _compute_rel_to_self(union_rels[union_id], _rel(union))
-                rels.append((profile, rel_to_self))
-
-        for rel in rels:
-            family[rel[1]].append(rel[0])
-
-        return family
-
-    def get_managed_profiles(self, fields: List[str]):
-        profiles = []
-        page = {'next_page': 'random', 'page': 0}
-        while 'next_page' in page:
-            args = {'page': page['page'] + 1}
-            if fields:
-                args.update({'fields': fields})
-            page = self.get('user/managed-profiles', args=args)
-            profiles.extend(page['results'])
-        return profiles
+    async def get_profiles(self, profile_ids, fields=None, cached=True):
+        args = {}
+        if fields:
+            args['fields'] = ','.join(fields)
+        args['ids'] = ','.join(profile_ids)
+        return await self.get('profile', args, cached=cached)
+
+    async def update_profile(self, profile_id, fields):
+        return await self.post(f'{profile_id}/update-basics', fields)
+
+    async def get_partner_unions(self, profile_id):
+        return _partner_unions(await self.get(f'{profile_id}/immediate-family'))
+
+    async def get_immediate_family(self, base_profile_id):
+        return _immediate_family(await self.get(f'{base_profile_id}/immediate-family'))
+
+    async def iter_managed_profiles(self, fields: List[str] = None,
+                                    prefetch=DEFAULT_PREFETCH_PAGES) -> AsyncIterator[dict]:
+        page = await self.get('user/managed-profiles', args=_page_args(1, fields))
+        for profile in page.get('results', []):
+            yield profile
+        page_count = _page_count(page)
+        if page_count is None:
+            number = 1
+            while 'next_page' in page:
+                number += 1
+                page = await self.get('user/managed-profiles', args=_page_args(number, fields))
+                for profile in page.get('results', []):
+                    yield profile
+            return
+        pending = deque()
+        try:
+            for number in range(2, page_count + 1):
+                pending.append(asyncio.ensure_future(self.get('user/managed-profiles', _page_args(number, fields))))
+                if len(pending) >= prefetch:
+                    for profile in (await pending.popleft()).get('results', []):
+                        yield profile
+            while pending:
+                for profile in (await pending.popleft()).get('results', []):
+                    yield profile
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def get_managed_profiles(self, fields: List[str] = None) -> List[dict]:
+        return [profile async for profile in self.iter_managed_profiles(fields)]
+
+    def close(self):
+        self.executor.shutdown()
 
 
 if __name__ == '__main__':
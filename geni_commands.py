@@ -0,0 +1,321 @@
+import re
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import unidecode
+
+
+class Commands:
+    END_NEW = 'end_new'
+    POP_ROOTS = 'pop_roots'
+    POP_ROOT = 'pop_root'
+    PUSH_ROOT = 'push_root'
+    SET_ROOT = 'set_root'
+    UPDATE_PROFILE = 'update_profile'
+    ADD_CHILDREN = 'add_children'
+    ADD_PARTNER = 'add_partner'
+    ADD_PARENTS = 'add_parents'
+    ADD_TREE = 'add_tree'
+    ADD_MARRIAGE = 'add_marriage'
+
+
+COMMANDS = frozenset(value for key, value in vars(Commands).items() if not key.startswith('_'))
+
+ROOT_COMMANDS = [Commands.PUSH_ROOT, Commands.POP_ROOT, Commands.POP_ROOTS]
+ADD_COMMANDS = [Commands.ADD_TREE, Commands.ADD_PARENTS, Commands.ADD_PARTNER, Commands.ADD_CHILDREN,
+                Commands.UPDATE_PROFILE]
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+GENDERS = ['f', 'm', 'o']
+EVENTS = ['birth', 'death', 'marriage']
+
+PROFILE_KEYS = {'age', 'name', 'birth_name', 'about_me', 'last_name', 'maiden_name', 'first_name', 'nicknames',
+                'living', 'gender'} | {f'{event}_{part}' for event in EVENTS for part in ['date', 'town']}
+SET_ROOT_KEYS = PROFILE_KEYS | {'id'}
+MARRIAGE_SECTION_KEYS = {
+    'marriage': {'section', 'record', 'date', 'town'},
+    'groom': PROFILE_KEYS | {'section', 'parents'},
+    'bride': PROFILE_KEYS | {'section', 'parents'},
+}
+
+DATE = re.compile(r'^\d{1,2}-[A-Za-z]+-\d{1,4}$')
+AGE = re.compile(r'^\d+:\d{1,4}$')
+
+# One blank-line separated block of `key: value` lines, and one command with its records; line numbers are 1-based.
+FileRecord = namedtuple('FileRecord', ['line', 'fields'])
+FileCommand = namedtuple('FileCommand', ['line', 'name', 'records'])
+
+
+def parse_commands(lines: Iterable[str]) -> List[FileCommand]:
+    """Tokenizes a command file in one pass, up to its first end_new line."""
+    commands = []
+    record = None
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if line in COMMANDS:
+            if line == Commands.END_NEW:
+                break
+            commands.append(FileCommand(line=number, name=line, records=[]))
+            record = None
+        elif not line:
+            record = None
+        elif ': ' in line:
+            if not commands:
+                raise Exception(f'Bad line {number}, before any command: {line}')
+            if record is None:
+                record = FileRecord(line=number, fields={})
+                commands[-1].records.append(record)
+            key, value = line.split(':', maxsplit=1)
+            record.fields[key] = value.strip()
+        else:
+            raise Exception(f'Bad line {number}: {line}')
+    return commands
+
+
+def field_errors(record: FileRecord, keys, marriage=False) -> List[str]:
+    errors = [f'Line {record.line}: unknown key {key}' for key in record.fields if key not in keys]
+    fields = record.fields
+    if 'gender' in fields and fields['gender'] not in GENDERS:
+        errors.append(f'Line {record.line}: gender must be one of {GENDERS}, not {fields["gender"]}')
+    for key in [f'{event}_date' for event in EVENTS] + (['date'] if marriage else []):
+        if key in fields and (not DATE.match(fields[key]) or fields[key].split('-')[1][:3].lower() not in MONTHS):
+            errors.append(f'Line {record.line}: {key} must look like 25-Mar-1889, not {fields[key]}')
+    if 'age' in fields and not (fields['age'].isdigit() if marriage else AGE.match(fields['age'])):
+        errors.append(f'Line {record.line}: age must be ' + ('a number' if marriage else 'age:year'))
+    return errors
+
+
+def marriage_errors(command: FileCommand) -> List[str]:
+    sections = {}
+    errors = []
+    for record in command.records:
+        section = record.fields.get('section')
+        if section not in MARRIAGE_SECTION_KEYS:
+            errors.append(f'Line {record.line}: section must be one of {list(MARRIAGE_SECTION_KEYS)}')
+            continue
+        if section in sections:
+            errors.append(f'Line {record.line}: second {section} section')
+        sections[section] = record
+        errors.extend(field_errors(record, MARRIAGE_SECTION_KEYS[section], marriage=True))
+    for section, required in [('marriage', ['date', 'town', 'record']), ('groom', ['parents']), ('bride', ['name'])]:
+        if section not in sections:
+            errors.append(f'Line {command.line}: {command.name} without a {section} section')
+            continue
+        errors.extend(f'Line {sections[section].line}: {section} section without {key}'
+                      for key in required if key not in sections[section].fields)
+    for section in ['groom', 'bride']:
+        if section in sections and '/' not in sections[section].fields.get('parents', '/'):
+            errors.append(f'Line {sections[section].line}: parents must look like Father / Mother')
+    return errors
+
+
+def command_errors(command: FileCommand) -> List[str]:
+    if command.name == Commands.SET_ROOT:
+        if len(command.records) != 1:
+            return [f'Line {command.line}: {command.name} takes exactly one record']
+        return field_errors(command.records[0], SET_ROOT_KEYS)
+    if command.name in ROOT_COMMANDS:
+        return [f'Line {command.line}: {command.name} takes no records'] if command.records else []
+    if not command.records:
+        return []  # a template waiting to be filled in, like the add_tree at the top of a new file
+    if command.name == Commands.ADD_MARRIAGE:
+        return marriage_errors(command)
+    return [error for record in command.records for error in field_errors(record, PROFILE_KEYS)]
+
+
+def marriage_commands(command: FileCommand) -> List[FileCommand]:
+    """The add_tree, add_parents, add_partner and root commands that an add_marriage stands for."""
+    records = {record.fields['section']: record for record in command.records}
+    marriage_info = records['marriage'].fields
+    marriage_year = marriage_info['date'].split('-')[-1]
+
+    def new_command(name, record=None, info=None):
+        records = [FileRecord(line=record.line, fields=info)] if info is not None else []
+        return FileCommand(line=record.line if record else command.line, name=name, records=records)
+
+    commands = []
+    groom = records['groom']
+    groom_info = {k: v for k, v in groom.fields.items() if k not in ['parents', 'section']}
+    groom_info['about_me'] = marriage_info['record']
+    if 'age' in groom_info:
+        groom_info['age'] = f'{groom_info["age"]}:{marriage_year}'
+    groom_info['gender'] = 'm'
+    commands.append(new_command(Commands.ADD_TREE, groom, groom_info))
+
+    groom_parents = groom.fields['parents'].split('/')
+    commands.append(new_command(Commands.ADD_PARENTS, groom, {'first_name': groom_parents[0], 'gender': 'm'}))
+    commands.append(new_command(Commands.ADD_PARENTS, groom, {'birth_name': groom_parents[1], 'gender': 'f'}))
+
+    bride = records['bride']
+    bride_info = {k: v for k, v in bride.fields.items() if k not in ['parents', 'section']}
+    if 'age' in bride_info:
+        bride_info['age'] = f'{bride_info["age"]}:{marriage_year}'
+    bride_info['gender'] = 'f'
+    bride_info['birth_name'] = bride_info['name']
+    del bride_info['name']
+    bride_info['marriage_date'] = marriage_info['date']
+    bride_info['marriage_town'] = marriage_info['town']
+    commands.append(new_command(Commands.ADD_PARTNER, bride, bride_info))
+
+    if 'parents' in bride.fields:
+        commands.append(new_command(Commands.PUSH_ROOT, bride))
+        bride_parents = bride.fields['parents'].split('/')
+        commands.append(new_command(Commands.ADD_PARENTS, bride, {'first_name': bride_parents[0], 'gender': 'm'}))
+        commands.append(new_command(Commands.ADD_PARENTS, bride, {'birth_name': bride_parents[1], 'gender': 'f'}))
+
+    return commands
+
+
+def plan_commands(commands: List[FileCommand]) -> List[FileCommand]:
+    """The commands to execute, with every add_marriage replaced by the commands it stands for."""
+    planned = []
+    for command in commands:
+        if command.name not in [Commands.SET_ROOT] + ROOT_COMMANDS and not command.records:
+            continue
+        planned.extend(marriage_commands(command) if command.name == Commands.ADD_MARRIAGE else [command])
+    return planned
+
+
+def normalize_field(key, value):
+    """A field value as set_root compares it: dates by day, month and year, and text without accents, case or extra
+    spaces."""
+    if key.endswith('date') and DATE.match(value):
+        day, month, year = value.split('-')
+        return int(day), month[:3].lower(), int(year)
+    return ' '.join(unidecode.unidecode(value).casefold().split())
+
+
+class ProfileIndex:
+    """
+    Added profiles, with the file record each was added from, indexed by every normalized (key, value) of the
+    record. A set_root without an id finds the profiles whose record has all of its fields among those in the
+    shortest of their posting lists, instead of comparing every record. An index with a base only holds its own
+    entries, and finds the base's matches before them.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[dict, dict]] = (), base: Optional['ProfileIndex'] = None):
+        self.base = base
+        self.entries: List[Tuple[dict, dict]] = []
+        self.normalized: List[dict] = []
+        self.postings: Dict[tuple, List[int]] = {}
+        self.extend(entries)
+
+    def add(self, fields: dict, profile):
+        normalized = {key: normalize_field(key, value) for key, value in fields.items()}
+        for item in normalized.items():
+            self.postings.setdefault(item, []).append(len(self.entries))
+        self.entries.append((fields, profile))
+        self.normalized.append(normalized)
+
+    def extend(self, entries: Iterable[Tuple[dict, dict]]):
+        for fields, profile in entries:
+            self.add(fields, profile)
+
+    def find(self, fields: dict) -> List[Tuple[dict, dict]]:
+        """The entries whose record has all the fields, in the order they were added."""
+        wanted = {key: normalize_field(key, value) for key, value in fields.items()}
+        found = self.base.find(fields) if self.base else []
+        if not wanted:
+            return found + self.entries
+        candidates = min((self.postings.get(item, []) for item in wanted.items()), key=len)
+        return found + [self.entries[i] for i in candidates
+                        if all(self.normalized[i].get(key) == value for key, value in wanted.items())]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def root_errors(planned: List[FileCommand]) -> List[str]:
+    """Commands that would run without a base profile, or pop more roots than were pushed."""
+    errors = []
+    has_root = added = False
+    depth = 0
+    for command in planned:
+        if command.name in [Commands.SET_ROOT, Commands.ADD_TREE]:
+            has_root = True
+        elif command.name in ADD_COMMANDS + [Commands.PUSH_ROOT] and not has_root:
+            errors.append(f'Line {command.line}: {command.name} before any set_root or add_tree')
+        if command.name == Commands.PUSH_ROOT:
+            if not added:
+                errors.append(f'Line {command.line}: {command.name} before any profile was added')
+            depth += 1
+        elif command.name in [Commands.POP_ROOT, Commands.POP_ROOTS]:
+            if not depth:
+                errors.append(f'Line {command.line}: {command.name} without a push_root')
+            depth = depth - 1 if command.name == Commands.POP_ROOT and depth else 0
+        added = added or command.name in ADD_COMMANDS
+    return errors
+
+
+def lookup_errors(planned: List[FileCommand]) -> List[str]:
+    """set_root commands without an id that do not match exactly one of the records added before them."""
+    errors = []
+    added = ProfileIndex()
+    for command in planned:
+        if command.name in ADD_COMMANDS:
+            for record in command.records:
+                added.add(record.fields, None)
+        elif command.name == Commands.SET_ROOT and root_id(command) is None:
+            matches = added.find(command.records[0].fields)
+            if len(matches) != 1:
+                errors.append(f'Line {command.line}: {command.name} matches {len(matches)} profiles added before it'
+                              + (', add fields to tell them apart' if matches else ''))
+    return errors
+
+
+def validate_commands(commands: List[FileCommand]) -> List[str]:
+    """Every problem found in the parsed commands, before any of them is run."""
+    errors = [error for command in commands for error in command_errors(command)]
+    if errors:
+        return errors
+    planned = plan_commands(commands)
+    return root_errors(planned) + lookup_errors(planned)
+
+
+# Commands that only depend on the blocks in `after`, by index, and are run in order by one FileProcessor.
+PlanBlock = namedtuple('PlanBlock', ['commands', 'after'])
+
+
+def root_id(command: FileCommand) -> Optional[str]:
+    return command.records[0].fields.get('id') if command.name == Commands.SET_ROOT else None
+
+
+def plan_blocks(planned: List[FileCommand]) -> List[PlanBlock]:
+    """
+    Splits the planned commands into blocks that can run concurrently. A block starts at an add_tree, or at a
+    set_root while no roots are pushed, and ends before the next one. A push_root before anything is added in the
+    block needs the profile added by the previous block, so it continues that block instead. A block runs after
+    the earlier blocks on the same set_root id, and a set_root without an id, which looks up a profile added
+    earlier in the file, runs after all of them.
+    """
+    blocks = []
+    depth = 0
+    added = False
+    for command in planned:
+        if command.name == Commands.ADD_TREE:
+            depth = 0
+        starts = command.name == Commands.ADD_TREE or (command.name == Commands.SET_ROOT and not depth)
+        if not blocks or starts:
+            blocks.append([])
+            added = False
+        if command.name == Commands.PUSH_ROOT and not added and len(blocks) > 1:
+            block = blocks.pop()
+            blocks[-1].extend(block)
+            added = True
+        blocks[-1].append(command)
+        depth = depth + 1 if command.name == Commands.PUSH_ROOT else \
+            depth - 1 if command.name == Commands.POP_ROOT else 0 if command.name == Commands.POP_ROOTS else depth
+        added = added or command.name in ADD_COMMANDS
+
+    plan = []
+    for i, commands in enumerate(blocks):
+        roots = [root_id(command) for command in commands if command.name == Commands.SET_ROOT]
+        if any(root is None for root in roots):
+            after = tuple(range(i))
+        else:
+            after = tuple(j for j, block in enumerate(plan)
+                          if any(root_id(command) in roots for command in block.commands))
+        plan.append(PlanBlock(commands=commands, after=after))
+    return plan
@@ -1,19 +1,25 @@
-import urllib.request
-import urllib.parse
-import urllib.error
+import asyncio
 from queue import Queue
-from anytree import Node
 
-from family_tree import FamilyTree, Person, PersonData
-from geni_api import GeniApi
+import requests
+from anytree import Node, PreOrderIter
+
+from crawl_checkpoint import CrawlCheckpoint, ANCESTORS, DESCENDANTS
+from family_tree import FamilyTree, PersonData
+from geni_api import GeniApi, AsyncGeniApi, HumanRel, DEFAULT_POOL_SIZE, MAX_IDS_PER_REQUEST, profile_results
+from iter_utils import chunks
+from response_cache import ResponseCache
 
 GENI_BASE_URL = 'https://www.geni.com/api/'
 
+DETAIL_FIELDS = ['birth', 'death', 'about_me']
+
 
 def geni_to_person_data(geni_data):
     first, last = geni_data.get('first_name', ''), geni_data.get('last_name', '')
     return PersonData(id=geni_data['id'], first_name=first, last_name=last,
-                      display_name=geni_data.get('display_name', '{} {}'.format(first, last)))
+                      display_name=geni_data.get('display_name', '{} {}'.format(first, last)),
+                      updated_at=geni_data.get('updated_at'))
 
 
 def get_name(profile):
@@ -22,56 +28,236 @@ def get_name(profile):
     return '{} {}'.format(profile.get('first_name', ''), profile.get('last_name', ''))
 
 
+def add_crawled(family_tree: FamilyTree, root: Node):
+    """Adds everyone under a crawl node, with the parent/child edge to the node they were reached from."""
+    for node in PreOrderIter(root):
+        family_tree.add_person(node.data)
+        if node.parent is None:
+            continue
+        if node.direction == ANCESTORS:
+            family_tree.add_parent(node.parent.name, node.name)
+        else:
+            family_tree.add_parent(node.name, node.parent.name)
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get())
+    return items
+
+
 class GeniFamilyTreeGenerator:
-    def __init__(self):
-        self.geni = GeniApi()
+    def __init__(self, max_in_flight=1, cache: ResponseCache = None, checkpoint_path=None):
+        """:param max_in_flight: number of concurrent immediate-family requests; 1 crawls serially"""
+        self.checkpoint = CrawlCheckpoint(checkpoint_path) if checkpoint_path else None
+        self.geni = GeniApi(pool_size=max(max_in_flight, DEFAULT_POOL_SIZE), cache=cache)
+        self.async_geni = AsyncGeniApi(self.geni, max_in_flight=max_in_flight) if max_in_flight > 1 else None
         self.base_profile = self.geni.get('profile', {})
 
-    def enqueue_all(self, queue, items_to_enqueue, parent, processed):
+    def close(self):
+        """Shuts down the threads of the concurrent crawl; use the generator as a context manager to do it for you."""
+        if self.async_geni:
+            self.async_geni.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def enqueue_all(self, queue, items_to_enqueue, parent, processed, direction=ANCESTORS):
         for tree_child in items_to_enqueue:
             if tree_child['id'] not in processed:
-                queue.put(
-                    Node(name=tree_child['id'], parent=parent, data=geni_to_person_data(tree_child)))
+                queue.put(Node(name=tree_child['id'], parent=parent, data=geni_to_person_data(tree_child),
+                               direction=direction))
             else:
                 print(tree_child['id'], 'already processed!')
 
-    def process_queue(self, queue, max_depth, processing_ancestors):
-        processed = {}
-        new_queue = Queue()
-        new_queue_keys = set()
-        while not queue.empty():
-            current_node = queue.get()
-            current_id = current_node.name
-            processed[current_id] = current_node
-            if current_node.depth >= max_depth:
-                continue
-            print('Processing', current_id, current_node.data.display_name, '...')
+    def enqueue_family(self, queues, queue_name, current_node, family, processed, new_queue_keys):
+        parents, children = family[HumanRel.parent], family[HumanRel.child]
+        if queue_name == ANCESTORS:
+            self.enqueue_all(queues[ANCESTORS], parents, current_node, processed[ANCESTORS])
+            if DESCENDANTS in queues:
+                self.enqueue_all(queues[DESCENDANTS], children, current_node, new_queue_keys, DESCENDANTS)
+                new_queue_keys.update(child['id'] for child in children)
+        else:
+            self.enqueue_all(queues[DESCENDANTS], children, current_node, processed[DESCENDANTS], DESCENDANTS)
+
+    def new_queue(self, name):
+        return self.checkpoint.queue(name) if self.checkpoint else Queue()
+
+    def mark_processed(self, queue_name, node):
+        if self.checkpoint:
+            self.checkpoint.processed(queue_name, node)
+
+    def process_queues(self, queues, max_depth, processed, new_queue_keys):
+        """
+        Crawls the ancestors and descendants queues together, one generation step at a time. Every profile of a step
+        is fetched at once (concurrently when max_in_flight > 1), and a profile reached in both directions is fetched
+        only once. Nodes are then processed in queue order, so the result does not depend on max_in_flight.
+        :return: ids of the profiles whose family could not be fetched, left unprocessed in the checkpoint
+        """
+        families = {}
+        failed = []
+        while True:
+            frontiers = {queue_name: drain(queue) for queue_name, queue in queues.items()}
+            if not any(frontiers.values()):
+                break
+            to_fetch = list(dict.fromkeys(node.name for frontier in frontiers.values() for node in frontier
+                                          if node.depth < max_depth and node.name not in families))
+            if to_fetch:
+                print('Processing', len(to_fetch), 'profiles...')
+            families.update(self.get_families(to_fetch))
+            for queue_name, frontier in frontiers.items():
+                for current_node in frontier:
+                    processed[queue_name][current_node.name] = current_node
+                    if current_node.depth < max_depth:
+                        family = families[current_node.name]
+                        if isinstance(family, Exception):
+                            print('Error!', family, current_node)
+                            failed.append(current_node.name)
+                            continue  # not marked processed, so that a resumed crawl retries it
+                        self.enqueue_family(queues, queue_name, current_node, family, processed, new_queue_keys)
+                    self.mark_processed(queue_name, current_node)
+        return failed
+
+    async def fetch_families(self, profile_ids):
+        async def fetch(profile_id):
+            try:
+                return await self.async_geni.get_immediate_family(profile_id)
+            except requests.HTTPError as e:
+                return e
+
+        return dict(zip(profile_ids, await asyncio.gather(*[fetch(profile_id) for profile_id in profile_ids])))
+
+    async def fetch_profiles(self, profile_ids, fields, cached=True):
+        responses = await asyncio.gather(*[self.async_geni.get_profiles(chunk, fields=fields, cached=cached)
+                                           for chunk in chunks(profile_ids, MAX_IDS_PER_REQUEST)])
+        return [profile for response in responses for profile in profile_results(response)]
+
+    def get_profiles(self, profile_ids, fields, cached=True):
+        if self.async_geni:
+            return asyncio.run(self.fetch_profiles(profile_ids, fields, cached))
+        return [profile for chunk in chunks(profile_ids, MAX_IDS_PER_REQUEST)
+                for profile in profile_results(self.geni.get_profiles(chunk, fields=fields, cached=cached))]
+
+    def get_families(self, profile_ids):
+        if self.async_geni:
+            return asyncio.run(self.fetch_families(profile_ids))
+        families = {}
+        for profile_id in profile_ids:
             try:
-                parents, children = self.geni.get_immediate_family(current_id)
-                self.enqueue_all(queue, parents if processing_ancestors else children, current_node, processed)
-                if processing_ancestors:
-                    self.enqueue_all(new_queue, children, current_node, new_queue_keys)
-                    new_queue_keys = new_queue_keys.union([child['id'] for child in children])
-            except urllib.error.HTTPError as e:
-                print('Error!', e, current_node)
-        return processed, new_queue
-
-    def generate_tree(self, max_depth=10):
-        """:rtype FamilyTree"""
+                families[profile_id] = self.geni.get_immediate_family(profile_id)
+            except requests.HTTPError as e:
+                families[profile_id] = e
+        return families
+
+    def generate_tree(self, max_depth=10, resume=False, detail_fields=None, descendants=True):
+        """
+        :param max_depth: maximum number of generation steps from the root, up and then down
+        :param resume: continue the crawl saved at `checkpoint_path`, if it has the same root and max_depth
+        :param detail_fields: profile fields to hydrate into PersonData.details once the crawl is done
+        :param descendants: also crawl the descendants of every ancestor
+        :rtype FamilyTree
+        """
         root_profile = self.base_profile
-        root = Node(name=root_profile['id'], data=geni_to_person_data(root_profile))
-        ancestors_q = Queue()
-        ancestors_q.put(root)
-        processed_ancestors, descendants_q = self.process_queue(ancestors_q, max_depth, processing_ancestors=True)
-        # processed_descendants, _ = self.process_queue(descendants_q, max_depth, processing_ancestors=False)
-        processed_descendants = {}
-        processed = {}
-        for k, v in processed_ancestors.items():
-            processed[k] = Person(data=v.data, ancestors=v, descendants=processed_descendants[k] if k in processed_descendants else None)
-        for k, v in processed_descendants.items():
-            if k not in processed:
-                processed[k] = Person(data=v.data, ancestors=None, descendants=v)
-        return FamilyTree(root=root_profile['id'], people=processed)
+        queue_names = [ANCESTORS, DESCENDANTS] if descendants else [ANCESTORS]
+        state = self.checkpoint.resume(root_profile['id'], max_depth) if self.checkpoint and resume else None
+        if state:
+            root = state.root
+            queues = {queue_name: state.queues[queue_name] for queue_name in queue_names}
+            processed = state.processed
+            new_queue_keys = state.queued_keys.get(DESCENDANTS, set())
+        else:
+            if self.checkpoint:
+                self.checkpoint.start(root_profile['id'], max_depth)
+            root = Node(name=root_profile['id'], data=geni_to_person_data(root_profile), direction=ANCESTORS)
+            queues = {queue_name: self.new_queue(queue_name) for queue_name in queue_names}
+            queues[ANCESTORS].put(root)
+            processed = {ANCESTORS: {}, DESCENDANTS: {}}
+            new_queue_keys = set()
+        failed = self.process_queues(queues, max_depth, processed, new_queue_keys)
+        if failed and self.checkpoint:
+            raise Exception(f'Could not fetch {len(failed)} profiles, e.g. {failed[0]}; run again with resume=True '
+                            f'to retry them from {self.checkpoint.path}')
+        if failed:
+            print('Could not fetch', len(failed), 'profiles, the tree is missing their relatives')
+        elif self.checkpoint:
+            self.checkpoint.finish()
+        family_tree = FamilyTree(root=root_profile['id'])
+        add_crawled(family_tree, root)
+        if detail_fields:
+            self.hydrate_tree(family_tree, detail_fields)
+        return family_tree
+
+    def hydrate_tree(self, family_tree: FamilyTree, fields=None):
+        """
+        Fetches `fields` for everyone in the tree without details, MAX_IDS_PER_REQUEST profiles per request.
+        :return: number of people hydrated
+        """
+        fields = fields or DETAIL_FIELDS
+        profile_ids = [person_id for person_id in family_tree if family_tree.data(person_id).details is None]
+        hydrated = 0
+        for profile in self.get_profiles(profile_ids, fields=['id'] + fields):
+            if profile['id'] not in family_tree:
+                continue
+            details = {field: profile[field] for field in fields if field in profile}
+            family_tree.update_data(profile['id'], family_tree.data(profile['id'])._replace(details=details))
+            hydrated += 1
+        return hydrated
 
+    def refresh_tree(self, family_tree: FamilyTree, max_depth=10):
+        """
+        Patches a previously generated tree in place: only profiles whose updated_at changed have their immediate
+        family refetched, and only their new parents' ancestors are crawled.
+        :return: ids of the refreshed profiles
+        """
+        profiles = self.get_profiles(list(family_tree), fields=['id', 'updated_at'], cached=False)
+        changed = [profile['id'] for profile in profiles if profile['id'] in family_tree and
+                   (profile.get('updated_at') is None or
+                    profile['updated_at'] != family_tree.data(profile['id']).updated_at)]
+        print(len(changed), 'of', len(family_tree), 'profiles changed')
+        if self.geni.cache:
+            self.geni.cache.invalidate(changed)
+
+        generations = family_tree.generations()
+        queues = {}
+        crawl_roots = []
+        removals = []
+        additions = []
+        families = self.get_families(changed)
+        for profile_id in changed:
+            family = families[profile_id]
+            if isinstance(family, Exception):
+                print('Error!', family, profile_id)
+                continue
+            data = geni_to_person_data(family[HumanRel.self][0])
+            family_tree.update_data(profile_id, data)
+            if profile_id not in generations:
+                continue
+            parents = family[HumanRel.parent]
+            parent_ids = [parent['id'] for parent in parents]
+            removals.extend((profile_id, tree_parent_id) for tree_parent_id in family_tree.parents(profile_id)
+                            if tree_parent_id not in parent_ids)
+            additions.extend((profile_id, parent_id) for parent_id in parent_ids if parent_id in family_tree)
+            generation = generations[profile_id]
+            if generation < max_depth:
+                node = Node(name=profile_id, data=data, direction=ANCESTORS)
+                crawl_roots.append(node)
+                queue = queues.setdefault(generation, Queue())
+                self.enqueue_all(queue, [parent for parent in parents if parent['id'] not in family_tree], node,
+                                 family_tree)
 
+        for child_id, parent_id in removals:
+            family_tree.remove_parent(child_id, parent_id)
+        for child_id, parent_id in additions:
+            family_tree.add_parent(child_id, parent_id)
 
+        processed = {person_id: None for person_id in family_tree}
+        for generation, queue in sorted(queues.items()):
+            self.process_queues({ANCESTORS: queue}, max_depth - generation, {ANCESTORS: processed}, set())
+        for node in crawl_roots:
+            add_crawled(family_tree, node)
+        family_tree.remove_unreachable()
+        return changed
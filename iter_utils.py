@@ -0,0 +1,23 @@
+from collections import deque
+from itertools import islice
+from typing import Iterable, Iterator
+
+
+def chunks(items: Iterable, n):
+    """Yield successive n-sized chunks from items, taking them from the iterable only as needed."""
+    iterator = iter(items)
+    chunk = list(islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, n))
+
+
+def bounded_map(executor, fn, items: Iterable, window) -> Iterator:
+    """Like executor.map, in order, but with at most `window` items taken from the iterable and not yet yielded."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,98 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+
+def _retry_after_seconds(value: str) -> Optional[float]:
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allows bursts of `capacity` requests and `limit` per `window` seconds on average; shareable by threads and tasks."""
+
+    def __init__(self, limit: int, window: float, capacity: int = None, backoff_base: float = 1.,
+                 max_backoff: float = 60.):
+        self.rate = limit / window
+        self.capacity = capacity or limit
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.
+        self.rate_limited_responses = 0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def _reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            self.requests += 1
+            wait = max(0., self.updated + max(0., -self.tokens) / self.rate - now)
+            if wait:
+                self.throttled_requests += 1
+                self.throttled_seconds += wait
+            return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the next `seconds` seconds, then refill from empty."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0.)
+            self.updated = max(self.updated, now + seconds)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """Trust the server's view of the remaining quota when it is lower than ours."""
+        remaining = headers.get('X-API-Rate-Remaining')
+        if remaining is None or not remaining.isdigit():
+            return
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, float(remaining))
+
+    def backoff(self, headers: Mapping[str, str], attempt: int) -> float:
+        """Pause after a rate limited response, for Retry-After if given, else exponential backoff with full jitter."""
+        with self.lock:
+            self.rate_limited_responses += 1
+        delay = _retry_after_seconds(headers['Retry-After']) if 'Retry-After' in headers else None
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff_base * 2 ** attempt))
+        self.pause(delay)
+        return delay
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'throttled_requests': self.throttled_requests,
+            'throttled_seconds': self.throttled_seconds,
+            'rate_limited_responses': self.rate_limited_responses,
+        }
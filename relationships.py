@@ -0,0 +1,164 @@
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from family_tree import FamilyTree
+from geni_api import HumanRel
+
+Relationship = namedtuple('Relationship', ['label', 'common_ancestor', 'up', 'down', 'path'])
+
+ORDINALS = ['first', 'second', 'third', 'fourth', 'fifth', 'sixth', 'seventh', 'eighth', 'ninth', 'tenth']
+TIMES = ['once', 'twice', 'three times', 'four times', 'five times']
+
+
+def _greats(n):
+    return 'great-' * n if n < 3 else f'{n}x great-'
+
+
+def _ordinal(n):
+    suffix = 'th' if n % 100 in (11, 12, 13) else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    return f'{n}{suffix}'
+
+
+def _nth(n, words):
+    return words[n - 1] if n <= len(words) else _ordinal(n) if words is ORDINALS else f'{n} times'
+
+
+def relationship_label(up, down, half=False) -> str:
+    """
+    What B is to A, when their common ancestor is `up` generations above A and `down` generations above B.
+    :param half: for siblings, that they have only one parent in common
+    """
+    if up == 0 and down == 0:
+        return HumanRel.self.name
+    if down == 0:
+        return HumanRel.parent.name if up == 1 else _greats(up - 2) + 'grandparent'
+    if up == 0:
+        return HumanRel.child.name if down == 1 else _greats(down - 2) + 'grandchild'
+    if up == 1 and down == 1:
+        return 'half-' + HumanRel.sibling.name if half else HumanRel.sibling.name
+    if down == 1:
+        return _greats(up - 2) + 'aunt/uncle'
+    if up == 1:
+        return _greats(down - 2) + 'niece/nephew'
+    cousin = f'{_nth(min(up, down) - 1, ORDINALS)} cousin'
+    removed = abs(up - down)
+    return f'{cousin} {_nth(removed, TIMES)} removed' if removed else cousin
+
+
+class RelationshipIndex:
+    """
+    Relationship queries over a FamilyTree. Each person's ancestors, with their distance in generations, are computed
+    once from the parents' tables and memoized, so a common ancestor query only scans the smaller of two tables.
+    """
+
+    def __init__(self, family_tree: FamilyTree):
+        self.tree = family_tree
+        self.ancestor_tables: Dict[int, Dict[int, int]] = {}
+
+    def ancestors(self, i) -> Dict[int, int]:
+        tables = self.ancestor_tables
+        stack = [i]
+        while stack:
+            j = stack[-1]
+            if j in tables:
+                stack.pop()
+                continue
+            missing = [p for p in self.tree.parent_indices(j) if p not in tables]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            table = {j: 0}
+            for p in self.tree.parent_indices(j):
+                for ancestor, distance in tables[p].items():
+                    if distance + 1 < table.get(ancestor, distance + 2):
+                        table[ancestor] = distance + 1
+            tables[j] = table
+        return tables[i]
+
+    def _common_ancestor(self, a, b) -> Optional[Tuple[int, int, int]]:
+        a_table, b_table = self.ancestors(a), self.ancestors(b)
+        small, large = (a_table, b_table) if len(a_table) <= len(b_table) else (b_table, a_table)
+        best = None
+        for ancestor, distance in small.items():
+            if ancestor in large:
+                key = (distance + large[ancestor], max(distance, large[ancestor]))
+                if best is None or key < best[0]:
+                    best = (key, ancestor)
+        if best is None:
+            return None
+        ancestor = best[1]
+        return ancestor, a_table[ancestor], b_table[ancestor]
+
+    def common_ancestor(self, a_id, b_id) -> Optional[str]:
+        """The most recent common ancestor of two people, by the shortest combined distance."""
+        found = self._common_ancestor(self.tree.index[a_id], self.tree.index[b_id])
+        return self.tree.ids[found[0]] if found else None
+
+    def _line(self, i, ancestor) -> List[int]:
+        line = [i]
+        while line[-1] != ancestor:
+            distance = self.ancestors(line[-1])[ancestor]
+            line.append(next(p for p in self.tree.parent_indices(line[-1])
+                             if self.ancestors(p).get(ancestor) == distance - 1))
+        return line
+
+    def _path(self, indices) -> List[Tuple[str, HumanRel]]:
+        path = [(self.tree.ids[indices[0]], HumanRel.self)]
+        for previous, i in zip(indices, indices[1:]):
+            rel = HumanRel.parent if i in self.tree.parent_indices(previous) else HumanRel.child
+            path.append((self.tree.ids[i], rel))
+        return path
+
+    def shortest_path(self, a_id, b_id) -> Optional[List[Tuple[str, HumanRel]]]:
+        """Bidirectional BFS over parent and child edges; each step is what that person is to the previous one."""
+        a, b = self.tree.index[a_id], self.tree.index[b_id]
+        if a == b:
+            return self._path([a])
+        came_from = [{a: None}, {b: None}]
+        frontiers = [[a], [b]]
+        while frontiers[0] and frontiers[1]:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other = came_from[side], came_from[1 - side]
+            next_frontier = []
+            for i in frontiers[side]:
+                for j in list(self.tree.parent_indices(i)) + list(self.tree.child_indices(i)):
+                    if j in seen:
+                        continue
+                    seen[j] = i
+                    if j in other:
+                        return self._path(self._join(came_from, j))
+                    next_frontier.append(j)
+            frontiers[side] = next_frontier
+        return None
+
+    @staticmethod
+    def _join(came_from, meeting) -> List[int]:
+        halves = []
+        for seen in came_from:
+            half, i = [], meeting
+            while i is not None:
+                half.append(i)
+                i = seen[i]
+            halves.append(half)
+        return list(reversed(halves[0])) + halves[1][1:]
+
+    def relationship(self, a_id, b_id) -> Optional[Relationship]:
+        """What B is to A. Without a common ancestor the label is None and the path is the shortest one, if any."""
+        a, b = self.tree.index[a_id], self.tree.index[b_id]
+        found = self._common_ancestor(a, b)
+        if not found:
+            path = self.shortest_path(a_id, b_id)
+            return Relationship(label=None, common_ancestor=None, up=None, down=None, path=path) if path else None
+        ancestor, up, down = found
+        half = False
+        if up == 1 and down == 1:
+            # One known parent each may just be missing data; a second parent that is not shared is not.
+            a_parents, b_parents = set(self.tree.parent_indices(a)), set(self.tree.parent_indices(b))
+            half = len(a_parents & b_parents) == 1 and len(a_parents | b_parents) > 1
+        indices = self._line(a, ancestor) + list(reversed(self._line(b, ancestor)))[1:]
+        return Relationship(label=relationship_label(up, down, half), common_ancestor=self.tree.ids[ancestor], up=up,
+                            down=down, path=self._path(indices))
+
+    def relationships(self, pairs: Iterable[Tuple[str, str]]) -> List[Optional[Relationship]]:
+        return [self.relationship(a_id, b_id) for a_id, b_id in pairs]
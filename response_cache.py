@@ -0,0 +1,131 @@
+import json
+import sqlite3
+import threading
+import time
+from fnmatch import fnmatch
+from typing import Dict, Optional
+from urllib.parse import urlencode
+
+DAY = 24 * 60 * 60
+
+# Patterns are matched against the api path in order, first match wins; unmatched apis are not cached.
+DEFAULT_TTLS = {
+    '*/immediate-family': 7 * DAY,
+    'profile': DAY,
+    'profile-*': DAY,
+}
+
+DEFAULT_MAX_ENTRIES = 100000
+
+UNCACHED_ARGS = {'access_token'}
+LIST_ARGS = {'ids', 'fields'}
+
+
+def cache_key(api, args):
+    normalized = {}
+    for k, v in args.items():
+        if k in UNCACHED_ARGS:
+            continue
+        if k in LIST_ARGS and isinstance(v, str):
+            v = ','.join(sorted(v.split(',')))
+        normalized[k] = v
+    return f'{api}?{urlencode(sorted(normalized.items()))}'
+
+
+def referenced_ids(response) -> set:
+    """Ids of the profiles and unions whose data is part of a response."""
+    ids = set()
+    if not isinstance(response, dict):
+        return ids
+    if 'id' in response:
+        ids.add(response['id'])
+    if 'focus' in response:
+        ids.add(response['focus']['id'])
+    ids.update(response.get('nodes', {}).keys())
+    ids.update(result['id'] for result in response.get('results', []) if 'id' in result)
+    return ids
+
+
+class ResponseCache:
+    """
+    Persistent cache of GET responses in SQLite, with per-api TTLs and LRU eviction beyond `max_entries`.
+    Each entry is indexed by the profiles and unions it contains so that writes can invalidate them.
+    """
+
+    def __init__(self, path, ttls: Dict[str, float] = None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(key TEXT PRIMARY KEY, response TEXT, expires REAL, accessed REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS response_ids (id TEXT, key TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS response_ids_id ON response_ids (id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS response_ids_key ON response_ids (key)')
+        self.size = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self, api) -> Optional[float]:
+        for pattern, ttl in self.ttls.items():
+            if fnmatch(api, pattern):
+                return ttl
+        return None
+
+    def _delete(self, keys):
+        for key in keys:
+            self.size -= self.db.execute('DELETE FROM responses WHERE key = ?', (key,)).rowcount
+            self.db.execute('DELETE FROM response_ids WHERE key = ?', (key,))
+
+    def get(self, api, args):
+        if not self.ttl(api):
+            return None
+        key = cache_key(api, args)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT response, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row and row[1] < now:
+                self._delete([key])
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, api, args, response):
+        ttl = self.ttl(api)
+        if not ttl:
+            return
+        key = cache_key(api, args)
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            self._delete([key])
+            self.db.execute('INSERT INTO responses VALUES (?, ?, ?, ?)', (key, json.dumps(response), now + ttl, now))
+            self.db.executemany('INSERT INTO response_ids VALUES (?, ?)',
+                                [(i, key) for i in referenced_ids(response)])
+            self.size += 1
+            if self.size > self.max_entries:
+                self._delete([k for k, in self.db.execute('SELECT key FROM responses ORDER BY accessed LIMIT ?',
+                                                          (self.size - self.max_entries,)).fetchall()])
+            self.db.execute('COMMIT')
+
+    def invalidate(self, ids):
+        """Drop every cached response containing any of the given profile or union ids."""
+        with self.lock:
+            self.db.execute('BEGIN')
+            for i in ids:
+                self._delete([k for k, in self.db.execute('SELECT key FROM response_ids WHERE id = ?',
+                                                          (i,)).fetchall()])
+            self.db.execute('COMMIT')
+
+    def invalidate_post(self, api, response):
+        self.invalidate({api.split('/')[0]}.union(referenced_ids(response)))
+
+    def close(self):
+        self.db.close()
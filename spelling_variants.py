@@ -0,0 +1,155 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Set
+
+import unidecode
+
+SpellingCluster = namedtuple('SpellingCluster', ['spellings', 'secondary_spellings'])
+
+VOWELS = 'AEIOU'
+DM_LENGTH = 6
+
+# Daitch-Mokotoff Soundex: codes at the start of a name, before a vowel, and elsewhere. '' is not coded, and '|'
+# separates the alternatives of ambiguous letters, each of which gives the name another code.
+DM_RULES = {
+    'AI': ('0', '1', ''), 'AJ': ('0', '1', ''), 'AY': ('0', '1', ''), 'AU': ('0', '7', ''), 'A': ('0', '', ''),
+    'B': ('7', '7', '7'),
+    'CHS': ('5', '54', '54'), 'CH': ('5|4', '5|4', '5|4'), 'CK': ('5|45', '5|45', '5|45'),
+    'CSZ': ('4', '4', '4'), 'CZS': ('4', '4', '4'), 'CZ': ('4', '4', '4'), 'CS': ('4', '4', '4'),
+    'C': ('5|4', '5|4', '5|4'),
+    'DRZ': ('4', '4', '4'), 'DRS': ('4', '4', '4'), 'DSH': ('4', '4', '4'), 'DSZ': ('4', '4', '4'),
+    'DS': ('4', '4', '4'), 'DZH': ('4', '4', '4'), 'DZS': ('4', '4', '4'), 'DZ': ('4', '4', '4'),
+    'DT': ('3', '3', '3'), 'D': ('3', '3', '3'),
+    'EI': ('0', '1', ''), 'EJ': ('0', '1', ''), 'EY': ('0', '1', ''), 'EU': ('1', '1', ''), 'E': ('0', '', ''),
+    'FB': ('7', '7', '7'), 'F': ('7', '7', '7'),
+    'G': ('5', '5', '5'),
+    'H': ('5', '5', ''),
+    'IA': ('1', '', ''), 'IE': ('1', '', ''), 'IO': ('1', '', ''), 'IU': ('1', '', ''), 'I': ('0', '', ''),
+    'J': ('1|4', '1|4', '1|4'),
+    'KS': ('5', '54', '54'), 'KH': ('5', '5', '5'), 'K': ('5', '5', '5'),
+    'L': ('8', '8', '8'),
+    'MN': ('66', '66', '66'), 'M': ('6', '6', '6'),
+    'NM': ('66', '66', '66'), 'N': ('6', '6', '6'),
+    'OI': ('0', '1', ''), 'OJ': ('0', '1', ''), 'OY': ('0', '1', ''), 'O': ('0', '', ''),
+    'PF': ('7', '7', '7'), 'PH': ('7', '7', '7'), 'P': ('7', '7', '7'),
+    'Q': ('5', '5', '5'),
+    'RZ': ('94|4', '94|4', '94|4'), 'RS': ('94|4', '94|4', '94|4'), 'R': ('9', '9', '9'),
+    'SCHTSCH': ('2', '4', '4'), 'SCHTSH': ('2', '4', '4'), 'SCHTCH': ('2', '4', '4'), 'SCHT': ('2', '43', '43'),
+    'SCHD': ('2', '43', '43'), 'SCH': ('4', '4', '4'),
+    'SHTCH': ('2', '4', '4'), 'SHTSH': ('2', '4', '4'), 'SHCH': ('2', '4', '4'), 'SHT': ('2', '43', '43'),
+    'SHD': ('2', '43', '43'), 'SH': ('4', '4', '4'),
+    'STSCH': ('2', '4', '4'), 'STRZ': ('2', '4', '4'), 'STRS': ('2', '4', '4'), 'STCH': ('2', '4', '4'),
+    'STSH': ('2', '4', '4'), 'ST': ('2', '43', '43'),
+    'SZCZ': ('2', '4', '4'), 'SZCS': ('2', '4', '4'), 'SZT': ('2', '43', '43'), 'SZD': ('2', '43', '43'),
+    'SZ': ('4', '4', '4'), 'SC': ('2', '4', '4'), 'SD': ('2', '43', '43'), 'S': ('4', '4', '4'),
+    'TTSCH': ('4', '4', '4'), 'TTCH': ('4', '4', '4'), 'TTSZ': ('4', '4', '4'), 'TTS': ('4', '4', '4'),
+    'TTZ': ('4', '4', '4'), 'TCH': ('4', '4', '4'), 'TSCH': ('4', '4', '4'), 'TSH': ('4', '4', '4'),
+    'TRZ': ('4', '4', '4'), 'TRS': ('4', '4', '4'), 'TZS': ('4', '4', '4'), 'TSZ': ('4', '4', '4'),
+    'TH': ('3', '3', '3'), 'TS': ('4', '4', '4'), 'TC': ('4', '4', '4'), 'TZ': ('4', '4', '4'), 'T': ('3', '3', '3'),
+    'UI': ('0', '1', ''), 'UJ': ('0', '1', ''), 'UY': ('0', '1', ''), 'UE': ('0', '', ''), 'U': ('0', '', ''),
+    'V': ('7', '7', '7'),
+    'W': ('7', '7', '7'),
+    'X': ('5', '54', '54'),
+    'Y': ('1', '', ''),
+    'ZHDZH': ('2', '4', '4'), 'ZDZH': ('2', '4', '4'), 'ZSCH': ('4', '4', '4'), 'ZDZ': ('2', '4', '4'),
+    'ZHD': ('2', '43', '43'), 'ZSH': ('4', '4', '4'), 'ZD': ('2', '43', '43'), 'ZH': ('4', '4', '4'),
+    'ZS': ('4', '4', '4'), 'Z': ('4', '4', '4'),
+}
+DM_PATTERNS = sorted(DM_RULES, key=len, reverse=True)
+
+NOT_LETTERS = re.compile(r'[^a-z]')
+
+
+@lru_cache(maxsize=2 ** 16)
+def normalize(name: str) -> str:
+    """Transliterated to ASCII and casefolded, without spaces and punctuation: Friedmann, FRIEDMANN, Friedmänn."""
+    return NOT_LETTERS.sub('', unidecode.unidecode(name).casefold())
+
+
+def words(name: str) -> List[str]:
+    """The normalized words of a name, so that Friedman-Cohen matches both surnames."""
+    return [word for word in NOT_LETTERS.split(unidecode.unidecode(name).casefold()) if word]
+
+
+@lru_cache(maxsize=2 ** 16)
+def daitch_mokotoff(name: str) -> FrozenSet[str]:
+    """The Daitch-Mokotoff Soundex codes of a name, more than one when it has ambiguous letters."""
+    letters = normalize(name).upper()
+    branches = {('', None)}  # (code so far, last letter code)
+    i = 0
+    while i < len(letters):
+        pattern = next((p for p in DM_PATTERNS if letters.startswith(p, i)), None)
+        if pattern is None:
+            i += 1
+            continue
+        after = i + len(pattern)
+        column = 0 if i == 0 else 1 if after < len(letters) and letters[after] in VOWELS else 2
+        alternatives = DM_RULES[pattern][column].split('|')
+        branches = {branch for code, last in branches for alternative in alternatives
+                    for branch in [(code if last and last.endswith(alternative) else code + alternative,
+                                    alternative)]}
+        i = after
+    return frozenset((code + '0' * DM_LENGTH)[:DM_LENGTH] for code, _ in branches)
+
+
+PHONETIC_KEY = 'dm:'
+
+
+@lru_cache(maxsize=2 ** 16)
+def spelling_keys(name: str, phonetic=False) -> FrozenSet[str]:
+    """Index keys of every word of a name: the word itself, and optionally its Daitch-Mokotoff codes."""
+    keys = set()
+    for word in words(name):
+        keys.add(word)
+        if phonetic:
+            keys.update(PHONETIC_KEY + code for code in daitch_mokotoff(word))
+    return frozenset(keys)
+
+
+class SpellingIndex:
+    """
+    Normalized and phonetic keys of the spellings of any number of surname clusters, mapped to the clusters, so each
+    profile name is looked up once against all of them. Daitch-Mokotoff codes are too coarse to decide a match on
+    their own (Wertman and Friedman share one), so phonetic matches are only suggestions for review.
+    """
+
+    def __init__(self, clusters: Iterable[SpellingCluster], phonetic=False):
+        self.clusters: List[SpellingCluster] = list(clusters)
+        self.phonetic = phonetic
+        self.index: Dict[str, Set[int]] = {}
+        for i, cluster in enumerate(self.clusters):
+            for spelling in set(cluster.spellings) | set(cluster.secondary_spellings or ()):
+                for key in spelling_keys(spelling, phonetic):
+                    self.index.setdefault(key, set()).add(i)
+
+    def _match(self, names: Iterable[str], phonetic) -> Set[int]:
+        matches = set()
+        for name in names:
+            for key in spelling_keys(name, self.phonetic):
+                if key.startswith(PHONETIC_KEY) == phonetic:
+                    matches.update(self.index.get(key, ()))
+        return matches
+
+    def match(self, names: Iterable[str]) -> Set[int]:
+        """Indices of the clusters with a spelling that any of the names is, up to accents and case."""
+        return self._match(names, phonetic=False)
+
+    def phonetic_match(self, names: List[str]) -> Set[int]:
+        """Indices of the clusters that only sound like one of the names, empty unless the index is phonetic."""
+        return self._match(names, phonetic=True) - self.match(names)
+
+    def missing_spellings(self, names: List[str], present_names: List[str] = ()) -> List[str]:
+        """
+        The spellings of the clusters matched by the names that are not among the names or present_names, even
+        with other accents or case.
+        """
+        present_names = list(names) + list(present_names)
+        present = set(normalize(name) for name in present_names).union(*[words(name) for name in present_names])
+        missing = []
+        for i in sorted(self.match(names)):
+            for spelling in sorted(self.clusters[i].spellings):
+                if normalize(spelling) not in present:
+                    present.add(normalize(spelling))
+                    missing.append(spelling)
+        return missing
@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+from update_lib import Update, UpdateResult, apply_updates
+
+PLANNED = 'planned'
+STARTED = 'started'
+APPLIED = 'applied'
+FAILED = 'failed'
+
+
+def encode_update(value):
+    if hasattr(value, '_asdict'):
+        return {'type': type(value).__name__, 'fields': value._asdict()}
+    return {'type': None, 'value': value}
+
+
+def decode_update(encoded, update_type=None):
+    if encoded['type'] is None:
+        return encoded['value']
+    if update_type is None or update_type.__name__ != encoded['type']:
+        raise Exception(f'Journal has {encoded["type"]} updates, not {update_type}')
+    return update_type(**encoded['fields'])
+
+
+def journal_key(update: Update, occurrence=0) -> str:
+    """
+    Identifies an update by what it changes, so the same update planned again in a later run is recognized, and by
+    how many identical updates were planned before it, so that e.g. two identical children added to the same
+    profile are told apart.
+    """
+    key = json.dumps(encode_update(update.update), sort_keys=True, default=str)
+    return f'{key}#{occurrence}' if occurrence else key
+
+
+class UpdateJournal:
+    """
+    Append-only, fsynced journal of bulk updates. Every update is recorded as planned before any of them is applied
+    (when streaming, before any of its fetched chunk), as started right before do_update, and with its result or
+    error once do_update returns. An update that was started but never finished may or may not have reached Geni,
+    and is not applied again unless asked to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: Dict[str, dict] = {}
+        self.occurrences = Counter()  # identical updates planned so far in this run
+        if os.path.exists(path):
+            self._replay()
+        self.file = open(path, 'a')
+
+    def _replay(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # partially written last line
+                if event['event'] == PLANNED:
+                    self.entries[event['key']] = event
+                else:
+                    self.entries[event['key']].update(event)
+
+    def _write(self, event):
+        with self.lock:
+            entry = self.entries.setdefault(event['key'], {})
+            entry.update(event)
+            self.file.write(json.dumps(event, default=str) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def state(self, key) -> Optional[str]:
+        entry = self.entries.get(key)
+        return entry['event'] if entry else None
+
+    def keyed(self, pending: UpdateResult) -> UpdateResult:
+        """The update with its journal key, numbering identical updates in the order they are planned."""
+        if pending.journal_key:
+            return pending  # read back from the journal
+        key = journal_key(pending.update)
+        with self.lock:
+            occurrence = self.occurrences[key]
+            self.occurrences[key] += 1
+        return pending._replace(journal_key=journal_key(pending.update, occurrence))
+
+    def prepare(self, pending: UpdateResult, retry_in_doubt=False) -> Optional[UpdateResult]:
+        """
+        Journals a keyed update as planned and returns None if it should be applied. Otherwise returns its result: the
+        one recorded when it was applied in an earlier run, or an error if it was started and never finished.
+        """
+        key = pending.journal_key
+        state = self.state(key)
+        if state == APPLIED:
+            print('Already applied:', pending.update.message)
+            return pending._replace(result=self.entries[key]['result'])
+        if state == STARTED and not retry_in_doubt:
+            print('Started in an earlier run, check it on Geni:', pending.update.message)
+            return pending._replace(error=Exception('Update started in an earlier run and never finished'))
+        if state != PLANNED:
+            self._write({'event': PLANNED, 'key': key, 'item': pending.key, 'message': pending.update.message,
+                         'update': encode_update(pending.update.update)})
+        return None
+
+    def started(self, pending: UpdateResult):
+        self._write({'event': STARTED, 'key': pending.journal_key})
+
+    def applied(self, pending: UpdateResult, result):
+        self._write({'event': APPLIED, 'key': pending.journal_key, 'result': result})
+
+    def failed(self, pending: UpdateResult, error):
+        self._write({'event': FAILED, 'key': pending.journal_key, 'error': str(error)})
+
+    def pending(self, update_type=None, retry_in_doubt=False, retry_failed=False) -> List[UpdateResult]:
+        """Journaled updates still to be applied, in the order they were planned."""
+        states = {PLANNED} | ({STARTED} if retry_in_doubt else set()) | ({FAILED} if retry_failed else set())
+        return [UpdateResult(key=entry['item'], update=Update(entry['message'],
+                                                              decode_update(entry['update'], update_type)),
+                             result=None, error=None, journal_key=key)
+                for key, entry in self.entries.items() if entry['event'] in states]
+
+    def close(self):
+        self.file.close()
+
+
+def resume_updates(updater, journal: UpdateJournal, apply_workers=1, retry_in_doubt=False,
+                   retry_failed=False) -> List[UpdateResult]:
+    """Applies the journaled updates that were planned but not applied, without fetching anything again."""
+    pending = journal.pending(updater.update_type, retry_in_doubt, retry_failed)
+    print(f'Resuming {len(pending)} updates from {journal.path}...')
+    results = apply_updates(updater, pending, apply_workers, journal, retry_in_doubt=True)
+    errors = sum(1 for result in results if result.error)
+    print(f'Done. {len(results) - errors} succeeded, {errors} failed.')
+    return results
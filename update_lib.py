@@ -1,11 +1,23 @@
 from collections import namedtuple
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from iter_utils import bounded_map, chunks
 
 Update = namedtuple('Update', ['message', 'update'])
 
+# One per update that was found: the item it was found for (None when get_updates does not return one update per
+# item), the return value of do_update, the exception if fetching or applying it failed, and the key it is recorded
+# under in an UpdateJournal.
+UpdateResult = namedtuple('UpdateResult', ['key', 'update', 'result', 'error', 'journal_key'], defaults=[None])
+
 
 class Updater:
+    # The namedtuple type of the updates, to read them back from an UpdateJournal
+    update_type = None
+
     def get_updates(self, keys: List[str]) -> List[Optional[Update]]:
+        """One update per key, None if there is nothing to update, or the exception if fetching it failed."""
         return [self.get_update(key) for key in keys]
 
     def get_update(self, key: str) -> Optional[Update]:
@@ -16,30 +28,129 @@ class Updater:
         pass
 
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
+def recording(items: Iterable, record: List) -> Iterator:
+    for item in items:
+        record.append(item)
+        yield item
+
+
+def auto_approve(_: Update) -> bool:
+    return True
+
+
+def fetch_chunk(updater, chunk) -> List[UpdateResult]:
+    try:
+        updates = updater.get_updates(chunk)
+    except Exception as e:
+        print('Failed to get updates for', chunk, e)
+        return [UpdateResult(key=key, update=None, result=None, error=e) for key in chunk]
+    keys = chunk if len(updates) == len(chunk) else [None] * len(updates)
+    return [UpdateResult(key=key, update=None, result=None, error=update) if isinstance(update, Exception) else
+            UpdateResult(key=key, update=update, result=None, error=None)
+            for key, update in zip(keys, updates) if update]
+
+
+def fetch_updates(updater, items, batch_size=1, fetch_workers=1) -> List[UpdateResult]:
+    """Runs get_updates on the chunks of items in a pool of fetch_workers threads, keeping the order of items."""
+    with ThreadPoolExecutor(fetch_workers) as executor:
+        fetched = executor.map(lambda chunk: fetch_chunk(updater, chunk), chunks(items, batch_size))
+        return [result for chunk_results in fetched for result in chunk_results]
+
+
+def apply_update(updater, pending: UpdateResult, journal=None) -> UpdateResult:
+    if journal:
+        journal.started(pending)
+    try:
+        result = updater.do_update(pending.update.update)
+    except Exception as e:
+        print('Failed:', pending.update.message, e)
+        if journal:
+            journal.failed(pending, e)
+        return pending._replace(error=e)
+    if journal:
+        journal.applied(pending, result)
+    return pending._replace(result=result)
+
+
+def prepare_updates(pending: Iterable[UpdateResult], journal=None,
+                    retry_in_doubt=False) -> Iterator[Tuple[UpdateResult, Optional[UpdateResult]]]:
+    """Pairs each update with its final result if it is not to be applied: failed fetches, and updates journaled as
+    applied or in doubt by an earlier run. The others are journaled as planned."""
+    for update in pending:
+        if update.error or not journal:
+            yield update, update if update.error else None
+        else:
+            update = journal.keyed(update)
+            yield update, journal.prepare(update, retry_in_doubt)
+
+
+def apply_updates(updater, pending: Iterable[UpdateResult], apply_workers=1, journal=None,
+                  retry_in_doubt=False) -> List[UpdateResult]:
+    """
+    Runs do_update on up to apply_workers updates at a time. A failure is recorded in its result instead of stopping
+    the others. Requests made through GeniApi are rate limited by its shared token bucket.
+    """
+    prepared = list(prepare_updates(pending, journal, retry_in_doubt))  # all planned before the first is applied
+    with ThreadPoolExecutor(apply_workers) as executor:
+        return list(executor.map(lambda p: p[1] or apply_update(updater, p[0], journal), prepared))
+
+
+def stream_updates(updater, items: Iterable, batch_size=1, fetch_workers=1, apply_workers=1,
+                   approve: Callable[[Update], bool] = auto_approve, journal=None,
+                   retry_in_doubt=False) -> Iterator[UpdateResult]:
+    """
+    Non-interactive update_items: fetching, approving and applying overlap, and only a few chunks are in flight at a
+    time, so memory does not grow with the number of items. Updates that `approve` rejects are skipped. Each fetched
+    chunk is journaled as planned before any of its updates is applied, not the whole run up front.
+    """
+    with ThreadPoolExecutor(fetch_workers) as fetcher, ThreadPoolExecutor(apply_workers) as applier:
+        fetched = bounded_map(fetcher, lambda chunk: fetch_chunk(updater, chunk), chunks(items, batch_size),
+                              2 * fetch_workers)
+        prepared = (pair for results in fetched
+                    for pair in list(prepare_updates([result for result in results
+                                                      if result.error or approve(result.update)],
+                                                     journal, retry_in_doubt)))
+        yield from bounded_map(applier, lambda p: p[1] or apply_update(updater, p[0], journal), prepared,
+                               2 * apply_workers)
+
+
+def update_items(updater, items, batch_size=1, fetch_workers=1, apply_workers=1,
+                 approve: Callable[[Update], bool] = None, journal=None, retry_in_doubt=False) -> List[UpdateResult]:
+    """
+    :param approve: policy deciding each update instead of asking for confirmation; see stream_updates
+    :param journal: UpdateJournal recording every update, so that a rerun skips the ones already applied
+    :param retry_in_doubt: apply again updates that a previous run started but did not see finish
+    """
+    if approve:
+        results = []
+        for result in stream_updates(updater, items, batch_size, fetch_workers, apply_workers, approve, journal,
+                                     retry_in_doubt):
+            if not result.error:
+                print('Done:', result.update.message)
+            results.append(result)
+        return results
 
-def update_items(updater, items, batch_size=1) -> List:
     update_confirmation = 'r'
     updates = []
+    failed = []
+    seen_items = []
+    # Items can be a generator, e.g. of managed profiles still being paged through; a retry goes over the same ones.
+    pending_items = recording(items, seen_items)
 
     while update_confirmation == 'r':
-        if batch_size > 1:
-            updates = [updater.get_updates(item) for item in chunks(items, batch_size)]
-            updates = [item for sublist in updates for item in sublist]
-        else:
-            updates = [updater.get_update(item) for item in items]
-        updates = list(filter(None, updates))
+        fetched = fetch_updates(updater, pending_items, batch_size, fetch_workers)
+        pending_items = seen_items
+        failed = [result for result in fetched if result.error]
+        updates = [result for result in fetched if not result.error]
 
         if not updates:
             update_confirmation = input('No updates found! [r]etry/[E]xit').lower().strip()
             continue
 
         for update in updates:
-            print(update.message)
+            print(update.update.message)
+        if failed:
+            print(f'Could not get updates for {len(failed)} items.')
 
         update_confirmation = input("Confirm [y]es/[r]etry/[N]o]").lower().strip()
 
@@ -47,14 +158,10 @@ def update_items(updater, items, batch_size=1) -> List:
 
     if not update_confirmed:
         print('Cancelling...')
-        return []
-
-    if update_confirmed:
-        print(f'Continuing with {len(updates)} updates...')
-        try:
-            results = [updater.do_update(update.update) for update in updates]
-        except Exception as e:
-            print(e)
-            raise
-        print('Done.')
-        return results
+        return failed
+
+    print(f'Continuing with {len(updates)} updates...')
+    results = apply_updates(updater, updates, apply_workers, journal, retry_in_doubt)
+    errors = sum(1 for result in results if result.error)
+    print(f'Done. {len(results) - errors} succeeded, {errors} failed.')
+    return failed + results